@@ -0,0 +1,298 @@
+""" Command line monitor and load generator: python -m aiopynoon --help """
+
+import argparse
+import asyncio
+import cProfile
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import time
+import tracemalloc
+import typing
+
+from .exceptions import NoonException
+from .line import NoonLine
+from .metrics import sample_percentile
+from .noon import Noon
+from .relay import NoonRelayClient
+from .replay import NoonRecorder, NoonReplay
+from .space import NoonSpace
+from .transport import create_session
+
+_LOGGER = logging.getLogger(__name__)
+
+""" Percentiles shown for latency distributions """
+PERCENTILES = (50, 90, 99)
+
+""" Number of functions shown from a profile """
+PROFILE_LIMIT = 25
+
+
+def _parse_args(argv: typing.List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m aiopynoon", description="Monitor or load-test a Noon account.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log debug output")
+    parser.add_argument("--profile", metavar="FILE", help="profile the run with cProfile, saving stats to FILE")
+    parser.add_argument("--tracemalloc", metavar="N", type=int, default=0, help="trace allocations and show the top N sites")
+
+    connection = parser.add_argument_group("connection", "Noon credentials (default), a relay, or a recording")
+    connection.add_argument("--username", default=os.environ.get("NOON_USERNAME"), help="defaults to $NOON_USERNAME")
+    connection.add_argument("--password", default=os.environ.get("NOON_PASSWORD"), help="defaults to $NOON_PASSWORD")
+    connection.add_argument("--relay", metavar="PATH", help="attach to a NoonRelayServer socket")
+    connection.add_argument("--replay", metavar="FILE", help="play back a recording made with 'monitor --record'")
+    connection.add_argument("--speed", type=float, default=1.0, help="replay speed (default 1)")
+    connection.add_argument("--repeat", action="store_true", help="replay the recording in a loop")
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    monitor = commands.add_parser("monitor", help="show live event stream metrics")
+    monitor.add_argument("--interval", type=float, default=1.0, help="seconds between reports (default 1)")
+    monitor.add_argument("--duration", type=float, help="stop after this many seconds")
+    monitor.add_argument("--events", action="store_true", help="also print every event")
+    monitor.add_argument("--json", action="store_true", help="print reports as JSON lines")
+    monitor.add_argument("--record", metavar="FILE", help="record state and changes to FILE for --replay")
+
+    bench = commands.add_parser("bench", help="send commands at a fixed rate and report latencies")
+    bench.add_argument("--rate", type=float, default=5.0, help="commands per second (default 5)")
+    bench.add_argument("--duration", type=float, default=30.0, help="seconds to send for (default 30)")
+    bench.add_argument("--kind", choices=["brightness", "scene", "mixed"], default="brightness")
+    bench.add_argument("--line", action="append", default=[], metavar="GUID", help="line to target (default all)")
+    bench.add_argument("--space", action="append", default=[], metavar="GUID", help="space to target (default all)")
+    bench.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for each command to apply")
+    bench.add_argument("--concurrency", type=int, default=50, help="most commands in flight at once")
+    bench.add_argument("--json", action="store_true", help="print the report as JSON")
+    bench.add_argument("--yes", action="store_true", help="confirm that lights may change (not needed with --replay)")
+
+    args = parser.parse_args(argv)
+    if args.relay is None and args.replay is None and (args.username is None or args.password is None):
+        parser.error("give --username and --password, --relay or --replay")
+    if args.command == "bench" and args.replay is None and not args.yes:
+        parser.error("bench will change real lights; pass --yes to continue")
+    return args
+
+
+async def _connect(args: argparse.Namespace) -> typing.Tuple[Noon, typing.Any]:
+    """Returns a started Noon for the chosen connection, and the session to close afterwards."""
+    session = None
+    if args.replay is not None:
+        noon = NoonReplay(args.replay, speed=args.speed, repeat=args.repeat)
+    elif args.relay is not None:
+        noon = NoonRelayClient(args.relay)
+    else:
+        session = create_session()
+        noon = Noon(session, args.username, args.password)
+    try:
+        await noon.start()
+    except BaseException:
+        if session is not None:
+            await session.close()
+        raise
+    return noon, session
+
+
+async def _disconnect(noon: Noon, session):
+    if isinstance(noon, NoonRelayClient):
+        await noon.close()
+    else:
+        await noon.close_eventstream()
+    if session is not None:
+        await session.close()
+
+
+def _milliseconds(seconds: float) -> float:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _distribution(samples: typing.List[float]) -> typing.Dict:
+    """Returns percentiles and the maximum of latency samples, in milliseconds."""
+    result = {"p{}".format(percentile): _milliseconds(sample_percentile(samples, percentile)) for percentile in PERCENTILES}
+    result["max"] = _milliseconds(max(samples)) if len(samples) > 0 else None
+    return result
+
+
+def _format_distribution(distribution: typing.Dict) -> str:
+    return " ".join("{}={}ms".format(key, "-" if value is None else value) for key, value in distribution.items())
+
+
+""" Monitor """
+
+async def _monitor(noon: Noon, args: argparse.Namespace):
+    recorder = None
+    if args.record is not None:
+        recorder = NoonRecorder(noon, args.record)
+        await recorder.start()
+
+    if args.events:
+        async def print_event(entity, context, event, params):
+            print("{} {} {} {}".format(time.strftime("%H:%M:%S"), entity.name, event, params), flush=True)
+        noon.subscribe(print_event, None)
+
+    started_at = time.monotonic()
+    try:
+        while args.duration is None or time.monotonic() - started_at < args.duration:
+            await asyncio.sleep(args.interval)
+            _report_metrics(noon, args.json)
+    finally:
+        if recorder is not None:
+            recorder.stop()
+
+
+def _report_metrics(noon: Noon, as_json: bool):
+    metrics = noon.metrics
+    report = {
+        "events": metrics.events,
+        "eventsPerSecond": round(metrics.events_per_second, 2),
+        "dispatchLatency": _distribution(list(metrics.dispatch_latencies)),
+        "reconnects": metrics.reconnects,
+        "connected": noon.event_stream_connected,
+        "streamBacklog": noon.stream_backlog,
+        "pendingCommands": noon.pending_command_count,
+    }
+    if as_json:
+        print(json.dumps(report), flush=True)
+        return
+    print("events={} rate={}/s dispatch[{}] reconnects={} connected={} backlog={} pending={}".format(
+        report["events"], report["eventsPerSecond"], _format_distribution(report["dispatchLatency"]),
+        report["reconnects"], report["connected"], "-" if report["streamBacklog"] is None else report["streamBacklog"],
+        report["pendingCommands"]), flush=True)
+
+
+""" Bench """
+
+class _BenchResults(object):
+    """Latencies and counts collected by a bench run."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.unconfirmed = 0
+        self.send_latencies = []
+        self.applied_latencies = []
+
+
+async def _bench(noon: Noon, args: argparse.Namespace):
+    targets = _bench_targets(noon, args)
+    if len(targets) == 0:
+        raise NoonException("Nothing to benchmark: no matching lines or spaces")
+
+    results = _BenchResults()
+    in_flight = asyncio.Semaphore(args.concurrency)
+    tasks = []
+    interval = 1 / args.rate
+    cycle = itertools.cycle(targets)
+    started_at = time.monotonic()
+    next_at = started_at
+    while next_at - started_at < args.duration:
+        await in_flight.acquire()
+        tasks.append(asyncio.ensure_future(_bench_command(next(cycle), args.timeout, in_flight, results)))
+        next_at = next_at + interval
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    await asyncio.gather(*tasks)
+    _report_bench(results, time.monotonic() - started_at, args.json)
+
+
+def _bench_targets(noon: Noon, args: argparse.Namespace) -> typing.List:
+    """Returns the lines and spaces to send commands to, in a shuffled order."""
+    targets = []
+    if args.kind in ("brightness", "mixed"):
+        lines = [noon.get_entity(guid) for guid in args.line] if len(args.line) > 0 else list(noon._lines.values())
+        targets.extend(line for line in lines if isinstance(line, NoonLine) and line.multiway_master is None)
+    if args.kind in ("scene", "mixed"):
+        spaces = [noon.get_entity(guid) for guid in args.space] if len(args.space) > 0 else list(noon._spaces.values())
+        targets.extend(space for space in spaces if isinstance(space, NoonSpace) and len(space.scenes) > 0)
+    random.shuffle(targets)
+    return targets
+
+
+async def _bench_command(target, timeout: float, in_flight: asyncio.Semaphore, results: _BenchResults):
+    """Send one command that changes the target, and time it."""
+    try:
+        sent_at = time.monotonic()
+        if isinstance(target, NoonLine):
+            levels = [level for level in range(10, 101, 10) if level != target.dimming_level]
+            command = await target.set_brightness(random.choice(levels))
+        else:
+            scenes = [scene_id for scene_id in target.scenes if scene_id != target.active_scene_id] or list(target.scenes)
+            command = await target.set_scene(active=True, scene_id=random.choice(scenes))
+        results.send_latencies.append(time.monotonic() - sent_at)
+        results.sent = results.sent + 1
+        if await command.applied(timeout):
+            results.applied_latencies.append(command.latency)
+        else:
+            results.unconfirmed = results.unconfirmed + 1
+    except NoonException as e:
+        _LOGGER.debug("Bench command to '{}' failed: {}".format(target.name, e))
+        results.failed = results.failed + 1
+    finally:
+        in_flight.release()
+
+
+def _report_bench(results: _BenchResults, elapsed: float, as_json: bool):
+    report = {
+        "elapsed": round(elapsed, 3),
+        "sent": results.sent,
+        "failed": results.failed,
+        "unconfirmed": results.unconfirmed,
+        "sentPerSecond": round(results.sent / elapsed, 2),
+        "appliedPerSecond": round(len(results.applied_latencies) / elapsed, 2),
+        "sendLatency": _distribution(results.send_latencies),
+        "appliedLatency": _distribution(results.applied_latencies),
+    }
+    if as_json:
+        print(json.dumps(report), flush=True)
+        return
+    print("sent {} commands in {}s ({}/s), {} applied ({}/s), {} failed, {} unconfirmed".format(
+        report["sent"], report["elapsed"], report["sentPerSecond"], len(results.applied_latencies),
+        report["appliedPerSecond"], report["failed"], report["unconfirmed"]))
+    print("send latency:    {}".format(_format_distribution(report["sendLatency"])))
+    print("applied latency: {}".format(_format_distribution(report["appliedLatency"])))
+
+
+""" Entry point """
+
+async def _run(args: argparse.Namespace):
+    noon, session = await _connect(args)
+    try:
+        if args.command == "monitor":
+            await _monitor(noon, args)
+        else:
+            await _bench(noon, args)
+    finally:
+        await _disconnect(noon, session)
+
+
+def main(argv: typing.List[str]=None) -> int:
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if args.tracemalloc > 0:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        asyncio.run(_run(args))
+    except KeyboardInterrupt:
+        pass
+    except NoonException as e:
+        print("{}: {}".format(type(e).__name__, e), file=sys.stderr)
+        return 1
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_LIMIT)
+        if args.tracemalloc > 0:
+            for statistic in tracemalloc.take_snapshot().statistics("lineno")[:args.tracemalloc]:
+                print(statistic, file=sys.stderr)
+            tracemalloc.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+""" Tracking for commands sent to Noon. """
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable
+
+from .const import Guid
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class NoonCommand(object):
+    """A command sent to Noon, whose effect can be awaited."""
+
+    @property
+    def tid(self) -> int:
+        """Returns the transaction ID sent with the command."""
+        return self._tid
+
+    @property
+    def target(self) -> Guid:
+        """Returns the GUID of the entity the command was sent to."""
+        return self._target
+
+    @property
+    def expected(self) -> Dict[str, Any]:
+        """Returns the fields (and values) the command is expected to change."""
+        return self._expected
+
+    @property
+    def sent_at(self) -> float:
+        """Returns the monotonic time the command was sent."""
+        return self._sent_at
+
+    @property
+    def latency(self) -> float:
+        """Returns seconds between sending and confirmation, or None if unconfirmed."""
+        return self._latency
+
+    @property
+    def done(self) -> bool:
+        return self._future.done()
+
+    def __init__(self, tid: int, target: Guid, expected: Dict[str, Any]):
+        """Initializes the command."""
+        self._tid = tid
+        self._target = target
+        self._expected = expected
+        self._remaining = set(expected.keys())
+        self._sent_at = time.monotonic()
+        self._latency = None
+        self._expiry = None
+        self._future = asyncio.get_running_loop().create_future()
+
+    async def applied(self, timeout: float=None) -> bool:
+        """Wait until Noon reports the command has been applied.
+
+        :param timeout: Seconds to wait, or None to wait indefinitely
+
+        :returns True if the change was confirmed, False if the wait timed out
+            or the command expired without confirmation
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._future), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    def _observe(self, fields: Dict[str, Any]) -> Iterable[str]:
+        """Record changed fields (and values) for the target, returning those this command consumed.
+
+        A field only counts if it changed to the value this command asked for.
+        """
+        consumed = set(name for name in self._remaining.intersection(fields) if fields[name] == self._expected[name])
+        self._remaining.difference_update(consumed)
+        if len(self._remaining) == 0:
+            self._complete(True)
+        return consumed
+
+    def _complete(self, applied: bool):
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        if self._future.done():
+            return
+        if applied:
+            self._latency = time.monotonic() - self._sent_at
+            _LOGGER.debug("Command {} confirmed after {:.3f}s".format(self._tid, self._latency))
+        self._future.set_result(applied)
+
+    def __repr__(self):
+        """Returns a stringified representation of this object."""
+        return str({'tid': self._tid, 'target': self._target, 'expected': self._expected,
+                    'latency': self._latency})
@@ -5,4 +5,7 @@ Guid = str
 
 # Endpoint URLs
 LOGIN_URL = "https://finn.api.noonhome.com/api/login"
-DEX_URL = "https://dex.api.noonhome.com/api/endpoints"
\ No newline at end of file
+DEX_URL = "https://dex.api.noonhome.com/api/endpoints"
+
+# Width (in percent) of the dimming level bands used to index lines
+DIMMING_BAND_WIDTH = 10
@@ -12,6 +12,21 @@ NoonEventHandler = Callable[['NoonEntity', Any, 'NoonEvent', Dict], None]
 
 _LOGGER = logging.getLogger(__name__)
 
+
+class _PendingChange(object):
+    """Optimistic local changes to one field awaiting confirmation from the event stream.
+
+    expected holds the values of the commands still in flight, oldest first;
+    previous is the last value Noon reported, restored if they are not applied.
+    """
+
+    def __init__(self, previous, setter):
+        self.expected = []
+        self.previous = previous
+        self.setter = setter
+        self.timer = None
+
+
 class NoonEntity(object):
 
     @property 
@@ -30,6 +45,7 @@ class NoonEntity(object):
         self._name = name
         self._guid = guid
         self._subscribers = []
+        self._pending_changes = {}
         noon._registerEntity(self)
 
     async def _dispatch_event(self, event: NoonEvent, params: Dict):
@@ -41,6 +57,7 @@ class NoonEntity(object):
                 await handler(self, context, event, params)
             except:
                 _LOGGER.exception("Exception handling update for {}".format(self.name))
+        await self._noon._dispatch_event(self, event, params)
 
     def subscribe(self, handler: NoonEventHandler, context):
         """Subscribes to events from this entity.
@@ -62,6 +79,76 @@ class NoonEntity(object):
         """Remove a specific handler."""
         self._subscribers.remove((handler, context))
     
+    def _reported_value(self, field: str, value):
+        """Returns the last value Noon reported for a field, given its local value.
+
+        They differ while an optimistic change to the field is unconfirmed.
+        """
+        pending = self._pending_changes.get(field, None)
+        return value if pending is None else pending.previous
+
+    def _record_history(self, field: str, value):
+        """Record a value reported by Noon in the state history, if enabled."""
+        history = self._noon.history
+        if history is not None:
+            history.record(self.guid, field, value)
+
+    async def _set_optimistic(self, field: str, value, previous, setter):
+        """Apply a change locally before Noon confirms it.
+
+        The change is confirmed by _update_field when the notification for the
+        newest command on the field arrives, and reverted if a notification
+        contradicts it or none arrives within the timeout. Notifications for
+        older commands still in flight are absorbed without touching the field.
+        """
+        pending = self._pending_changes.get(field, None)
+        if pending is None:
+            if value == previous:
+                return
+            pending = _PendingChange(previous, setter)
+            self._pending_changes[field] = pending
+        else:
+            pending.timer.cancel()
+        pending.expected.append(value)
+        pending.timer = asyncio.get_running_loop().call_later(
+            self._noon.optimistic_timeout,
+            lambda: asyncio.ensure_future(self._expire_optimistic(field, pending)))
+        await setter(value)
+
+    async def _expire_optimistic(self, field: str, pending: _PendingChange):
+        """Roll back optimistic changes that were never confirmed."""
+        if self._pending_changes.get(field) is not pending:
+            return
+        del self._pending_changes[field]
+        _LOGGER.debug("Optimistic change to '{}' on {} not confirmed, reverting".format(field, self.name))
+        await pending.setter(pending.previous)
+        await self._dispatch_event(self.Event.CHANGE_REVERTED, {field: pending.previous})
+
+    async def _update_field(self, field: str, value, setter):
+        """Apply a value from the event stream, reconciling any optimistic changes."""
+        self._record_history(field, value)
+        pending = self._pending_changes.get(field, None)
+        if pending is None:
+            await setter(value)
+            return
+        pending.previous = value
+
+        """ An older command landing is superseded by the newer ones still in flight """
+        if value in pending.expected:
+            del pending.expected[:pending.expected.index(value) + 1]
+            if len(pending.expected) > 0:
+                return
+            pending.timer.cancel()
+            del self._pending_changes[field]
+            await setter(value)
+            await self._dispatch_event(self.Event.CHANGE_CONFIRMED, {field: value})
+            return
+
+        pending.timer.cancel()
+        del self._pending_changes[field]
+        await setter(value)
+        await self._dispatch_event(self.Event.CHANGE_REVERTED, {field: value})
+
     async def handle_update(self, changed_fields):
         """The handle_update callback is invoked when an event is received
         for the this entity.
@@ -35,4 +35,8 @@ class NoonProtocolError(NoonException):
 
 class NoonEvent(object):
 
-    pass
\ No newline at end of file
+    pass
+
+class NoonCommunicationError(NoonException):
+
+    pass
@@ -0,0 +1,169 @@
+""" Bounded, array-backed history of entity state changes. """
+
+import logging
+import time
+import typing
+from array import array
+
+from .const import Guid
+
+_LOGGER = logging.getLogger(__name__)
+
+""" Samples kept across all entities, unless overridden """
+DEFAULT_BUDGET = 100000
+
+""" Fewest samples kept for any one entity """
+MIN_CAPACITY = 16
+
+_KIND_NONE = 0
+_KIND_NUMBER = 1
+_KIND_BOOL = 2
+_KIND_STRING = 3
+
+HistorySample = typing.Tuple[float, str, typing.Any]
+
+
+class _Ring(object):
+    """Fixed-size ring of (timestamp, field, value) samples."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.fields = array('B', bytes(capacity))
+        self.kinds = array('B', bytes(capacity))
+
+    def append(self, timestamp: float, field: int, kind: int, value: float):
+        if self.size < self.capacity:
+            index = (self.start + self.size) % self.capacity
+            self.size = self.size + 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[index] = timestamp
+        self.fields[index] = field
+        self.kinds[index] = kind
+        self.values[index] = value
+
+    def first_at_or_after(self, timestamp: float) -> int:
+        """Returns the logical position of the first sample at or after timestamp."""
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[(self.start + middle) % self.capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class NoonHistory(object):
+    """Per-entity ring buffers of field changes, bounded by a global budget.
+
+    Each tracked entity gets a ring of budget // max_entities samples (at
+    least MIN_CAPACITY); entities beyond max_entities are not recorded.
+    """
+
+    @property
+    def budget(self) -> int:
+        return self._budget
+
+    @property
+    def capacity(self) -> int:
+        """Returns the number of samples kept for each entity."""
+        return self._capacity
+
+    def __init__(self, max_entities: int, budget: int=DEFAULT_BUDGET):
+        """Create an empty history.
+
+        :param max_entities: Number of entities expected to be tracked
+        :param budget: Total number of samples kept across all entities
+        """
+        self._budget = budget
+        self._capacity = max(MIN_CAPACITY, budget // max(1, max_entities))
+        self._max_rings = max(1, budget // self._capacity)
+        self._rings = {}
+        self._field_codes = {}
+        self._field_names = []
+        self._string_codes = {}
+        self._strings = []
+
+    def _intern_field(self, field: str) -> int:
+        code = self._field_codes.get(field, None)
+        if code is None:
+            code = len(self._field_names)
+            assert code < 256, "Too many distinct fields"
+            self._field_codes[field] = code
+            self._field_names.append(field)
+        return code
+
+    def _encode(self, value) -> typing.Tuple[int, float]:
+        if value is None:
+            return _KIND_NONE, 0.0
+        elif isinstance(value, bool):
+            return _KIND_BOOL, 1.0 if value else 0.0
+        elif isinstance(value, (int, float)):
+            return _KIND_NUMBER, float(value)
+        value = str(value)
+        code = self._string_codes.get(value, None)
+        if code is None:
+            code = len(self._strings)
+            self._string_codes[value] = code
+            self._strings.append(value)
+        return _KIND_STRING, float(code)
+
+    def _decode(self, kind: int, value: float):
+        if kind == _KIND_NONE:
+            return None
+        elif kind == _KIND_BOOL:
+            return value != 0
+        elif kind == _KIND_STRING:
+            return self._strings[int(value)]
+        return int(value) if value.is_integer() else value
+
+    def record(self, guid: Guid, field: str, value, timestamp: float=None):
+        """Record a field change for an entity."""
+        ring = self._rings.get(guid, None)
+        if ring is None:
+            if len(self._rings) >= self._max_rings:
+                _LOGGER.debug("History budget exhausted, not recording {}".format(guid))
+                return
+            ring = _Ring(self._capacity)
+            self._rings[guid] = ring
+        kind, encoded = self._encode(value)
+        ring.append(time.time() if timestamp is None else timestamp, self._intern_field(field), kind, encoded)
+
+    def range(self, guid: Guid, start: float=None, end: float=None, field: str=None) -> typing.List[HistorySample]:
+        """Returns the samples for an entity between start and end (inclusive, wall-clock seconds).
+
+        :param field: Only return changes to this field
+        """
+        ring = self._rings.get(guid, None)
+        if ring is None:
+            return []
+        field_code = self._field_codes.get(field, -1) if field is not None else None
+        position = 0 if start is None else ring.first_at_or_after(start)
+        result = []
+        while position < ring.size:
+            index = (ring.start + position) % ring.capacity
+            timestamp = ring.times[index]
+            if end is not None and timestamp > end:
+                break
+            if field_code is None or ring.fields[index] == field_code:
+                result.append((timestamp, self._field_names[ring.fields[index]],
+                    self._decode(ring.kinds[index], ring.values[index])))
+            position = position + 1
+        return result
+
+    def last(self, guid: Guid, seconds: float, field: str=None) -> typing.List[HistorySample]:
+        """Returns the samples for an entity from the last `seconds` seconds."""
+        return self.range(guid, time.time() - seconds, None, field)
+
+    def clear(self, guid: Guid=None):
+        """Forget the history of one entity, or of all entities."""
+        if guid is None:
+            self._rings.clear()
+        else:
+            self._rings.pop(guid, None)
@@ -2,10 +2,11 @@
 
 from .entity import NoonEntity
 import asyncio
-from typing import Dict
+from typing import Dict, List
 import logging
 
 from .const import Guid
+from .command import NoonCommand
 from .entity import NoonEntity
 from .event import NoonEvent
 from .exceptions import NoonInvalidJsonError
@@ -33,6 +34,20 @@ class NoonLine(NoonEntity):
         """
         LINE_STATE_CHANGED = 2
 
+        """
+        CHANGE_CONFIRMED: An optimistic change was confirmed by Noon.
+            Params:
+            field name: Confirmed value
+        """
+        CHANGE_CONFIRMED = 3
+
+        """
+        CHANGE_REVERTED: An optimistic change was not applied by Noon.
+            Params:
+            field name: Actual value
+        """
+        CHANGE_REVERTED = 4
+
     @property
     def line_state(self) -> str:
         return self._line_state
@@ -40,9 +55,14 @@ class NoonLine(NoonEntity):
     async def set_line_state(self, value:str):
 
         value_changed = (self._line_state != value)
+        old_value = self._line_state
         self._line_state = value
         if value_changed:
-            await self._dispatch_event(NoonLine.Event.LINE_STATE_CHANGED, {ATTR_LINE_STATE: self._line_state})
+            self._noon._entity_field_changed(self, ATTR_LINE_STATE, old_value, value)
+            if self._emits_events:
+                await self._dispatch_event(NoonLine.Event.LINE_STATE_CHANGED, {ATTR_LINE_STATE: self._line_state})
+            for member in self.multiway_group:
+                await member.set_line_state(value)
     
     @property
     def parent_space(self):
@@ -54,55 +74,119 @@ class NoonLine(NoonEntity):
 
     async def set_dimming_level(self, value: int):
         value_changed = (self._dimming_level != value)
+        old_value = self._dimming_level
         self._dimming_level = value
         if value_changed:
-            await self._dispatch_event(NoonLine.Event.DIM_LEVEL_CHANGED, {ATTR_DIM_LEVEL: self._dimming_level})
+            self._noon._entity_field_changed(self, ATTR_DIM_LEVEL, old_value, value)
+            if self._emits_events:
+                await self._dispatch_event(NoonLine.Event.DIM_LEVEL_CHANGED, {ATTR_DIM_LEVEL: self._dimming_level})
+            for member in self.multiway_group:
+                await member.set_dimming_level(value)
+
+    @property
+    def multiway_master(self):
+        """Returns the master line of this line's multiway group, or None if this line is not a slave."""
+        return self._multiway_master
+
+    @property
+    def multiway_members(self) -> Dict:
+        """Returns the slave lines controlled by this line, if it is a multiway master."""
+        return self._multiway_members
+
+    @property
+    def multiway_group(self) -> List:
+        """Returns every line in this line's multiway group (master first), or [] if it has none."""
+        master = self._multiway_master or self
+        if len(master._multiway_members) == 0:
+            return []
+        return [master] + list(master._multiway_members.values())
+
+    @property
+    def _emits_events(self) -> bool:
+        """Slaves are silent if events are collapsed to one per multiway group."""
+        return self._multiway_master is None or not self._noon.collapse_multiway_events
+
+    async def set_brightness(self, brightness_level: int, transition_time:int=None) -> NoonCommand:
 
-    async def set_brightness(self, brightness_level: int, transition_time:int=None):
+        """ Multiway slaves are controlled through their master """
+        if self._multiway_master is not None:
+            return await self._multiway_master.set_brightness(brightness_level, transition_time)
 
-        """ (Re)authenticate if needed """
-        await self._noon.authenticate()
+        """ Work out which fields should change, from the state Noon last reported """
+        new_line_state = LINE_STATE_ON if brightness_level > 0 else LINE_STATE_OFF
+        expected = {}
+        if new_line_state != self._reported_value(ATTR_LINE_STATE, self._line_state):
+            expected[ATTR_LINE_STATE] = new_line_state
+        if brightness_level > 0 and brightness_level != self._reported_value(ATTR_DIM_LEVEL, self._dimming_level):
+            expected[ATTR_DIM_LEVEL] = brightness_level
 
         """ Send the command """
         _LOGGER.debug("Setting brightness to {}% with transition time {}s".format(brightness_level, transition_time))
-        actionUrl = "{}/api/action/line/lightLevel".format(self._noon._endpoints["action"])
-        json = {"line": self.guid, "lightLevel": brightness_level, "tid": 55555}
+        json = {"line": self.guid, "lightLevel": brightness_level}
         if transition_time is not None:
             json["transitionTime"] = transition_time
-        async with self._noon.session.post(actionUrl, headers={"Authorization": "Token {}".format(self._noon._token)}, json=json, raise_for_status=True) as raw_response:
-            _LOGGER.debug("Got set_brightness result {}: {}".format(raw_response.status, raw_response))
-    
+        command = await self._noon._send_command(self, "line/lightLevel", json, expected)
 
-    async def turn_on(self):
-        
-        await self.set_brightness(100)
+        """ Apply locally if optimistic """
+        if self._noon.optimistic:
+            await self._set_optimistic(ATTR_LINE_STATE, new_line_state, self._line_state, self.set_line_state)
+            if brightness_level > 0:
+                await self._set_optimistic(ATTR_DIM_LEVEL, brightness_level, self._dimming_level, self.set_dimming_level)
+
+        return command
 
-    async def turn_off(self):
+    async def turn_on(self) -> NoonCommand:
         
-        await self.set_brightness(0)
+        return await self.set_brightness(100)
 
-    def __init__(self, noon, parent_space, guid: Guid, name: str, dimming_level: int=None, line_state: bool=None):
+    async def turn_off(self) -> NoonCommand:
         
-        super().__init__(noon, guid, name)
+        return await self.set_brightness(0)
 
+    def __init__(self, noon, parent_space, guid: Guid, name: str, dimming_level: int=None, line_state: bool=None,
+            multiway_master_id: Guid=None):
+        
         """Initializes the Line."""
         self._line_state = None
         self._dimming_level = None
         self._parent_space = parent_space
         self._line_state = line_state
         self._dimming_level = dimming_level
+        self._multiway_master_id = multiway_master_id
+        self._multiway_master = None
+        self._multiway_members = {}
+
+        super().__init__(noon, guid, name)
+
+    def _record_history(self, field: str, value):
+        """Record a reported value for every line in the multiway group, as the setters copy it to all of them."""
+        history = self._noon.history
+        if history is None:
+            return
+        for line in self.multiway_group or [self]:
+            history.record(line.guid, field, value)
 
     async def handle_update(self, changed_fields):
         """Handle an update from an event notification."""
         _LOGGER.debug("Asked to update with {}".format(changed_fields))
         for changed_field in changed_fields:
             if changed_field["name"] == ATTR_LINE_STATE:
-                await self.set_line_state(changed_field["value"])
+                await self._update_field(ATTR_LINE_STATE, changed_field["value"], self.set_line_state)
             elif changed_field["name"] == ATTR_DIM_LEVEL:
-                await self.set_dimming_level(changed_field["value"])
+                await self._update_field(ATTR_DIM_LEVEL, changed_field["value"], self.set_dimming_level)
             else:
                 _LOGGER.warn("Unhandled change to field '{}'".format(changed_field["name"]))
 
+    def to_json(self) -> Dict:
+        """Returns this line in the same form as discovery."""
+        return {
+            "guid": self.guid,
+            "displayName": self.name,
+            "lineState": self._line_state,
+            "dimmingLevel": self._dimming_level,
+            "multiwayMaster": {"guid": self._multiway_master_id} if self._multiway_master_id is not None else None,
+        }
+
     @classmethod
     async def from_json(cls, noon, space, json):
         """Construct a Line from a JSON payload."""
@@ -119,7 +203,10 @@ class NoonLine(NoonEntity):
             raise NoonInvalidJsonError
         line_state = json.get("lineState", None)
         dimming_level = json.get("dimmingLevel", None)
-        new_line = NoonLine(noon, space, guid, name, dimming_level, line_state)
+        multiway_master_id = (json.get("multiwayMaster", None) or {}).get("guid", None)
+        if multiway_master_id == guid:
+            multiway_master_id = None
+        new_line = NoonLine(noon, space, guid, name, dimming_level, line_state, multiway_master_id)
 
         return new_line
 
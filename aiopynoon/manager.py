@@ -0,0 +1,225 @@
+""" Running many Noon accounts over one connection pool. """
+
+import asyncio
+import logging
+import time
+import typing
+from aiohttp import ClientSession
+
+from .noon import Noon
+from .entity import NoonEntity
+from .event import NoonEvent
+from .transport import create_session
+
+_LOGGER = logging.getLogger(__name__)
+
+ACCOUNT_STATE_PENDING = "pending"
+ACCOUNT_STATE_AUTHENTICATING = "authenticating"
+ACCOUNT_STATE_DISCOVERING = "discovering"
+ACCOUNT_STATE_CONNECTED = "connected"
+ACCOUNT_STATE_RECONNECTING = "reconnecting"
+ACCOUNT_STATE_ERROR = "error"
+ACCOUNT_STATE_STOPPED = "stopped"
+
+
+class NoonAccountEvent(object):
+    """An entity event, tagged with the account it came from."""
+
+    def __init__(self, account_id: str, entity: NoonEntity, event: NoonEvent, params: typing.Dict):
+        self.account_id = account_id
+        self.entity = entity
+        self.event = event
+        self.params = params
+
+    def __repr__(self):
+        """Returns a stringified representation of this object."""
+        return str({'account': self.account_id, 'entity': self.entity.guid,
+                    'event': self.event, 'params': self.params})
+
+
+class NoonAccount(object):
+    """A single account run by a NoonManager."""
+
+    @property
+    def account_id(self) -> str:
+        return self._account_id
+
+    @property
+    def noon(self) -> Noon:
+        return self._noon
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def last_error(self) -> str:
+        return self._last_error
+
+    def __init__(self, account_id: str, noon: Noon):
+        """Initializes the account."""
+        self._account_id = account_id
+        self._noon = noon
+        self._state = ACCOUNT_STATE_PENDING
+        self._last_error = None
+        self._failures = 0
+        self._discovered = False
+        self._task = None
+
+    def health(self) -> typing.Dict:
+        """Returns the state and metrics of this account as a dictionary."""
+        health = {
+            "state": self._state,
+            "lastError": self._last_error,
+            "eventStreamConnected": self._noon.event_stream_connected,
+        }
+        health.update(self._noon.metrics.as_dict())
+        return health
+
+
+class NoonManager(object):
+    """Runs many Noon accounts over a shared ClientSession.
+
+    Logins and discovery are staggered and limited to max_concurrency at a
+    time. Each account's event stream is supervised and reconnected with
+    backoff, and events from every account are merged into one feed.
+    """
+
+    @property
+    def session(self) -> ClientSession:
+        return self._session
+
+    @property
+    def accounts(self) -> typing.Dict[str, NoonAccount]:
+        return self._accounts
+
+    @property
+    def dropped_events(self) -> int:
+        """Returns the number of events discarded because the feed was full."""
+        return self._dropped_events
+
+    def __init__(self, session: ClientSession=None, max_concurrency: int=10, login_interval: float=0.2,
+            reconnect_backoff: float=5, max_reconnect_backoff: float=300, max_queued_events: int=10000):
+        """Create a manager.
+
+        :param session: Shared session; one using the Noon connection profile is
+            created (and closed) by the manager if omitted
+        :param max_concurrency: Maximum number of logins/discoveries in flight
+        :param login_interval: Minimum seconds between account start-ups
+        :param reconnect_backoff: Initial delay before restarting a failed account
+        :param max_reconnect_backoff: Maximum delay before restarting a failed account
+        :param max_queued_events: Size of the merged event feed
+        """
+        self._session = session
+        self._owns_session = session is None
+        self._accounts = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._login_interval = login_interval
+        self._next_login = 0
+        self._reconnect_backoff = reconnect_backoff
+        self._max_reconnect_backoff = max_reconnect_backoff
+        self._events = asyncio.Queue(maxsize=max_queued_events)
+        self._dropped_events = 0
+        self._running = False
+
+    def add_account(self, account_id: str, username: str, password: str, **kwargs) -> Noon:
+        """Add an account, starting it straight away if the manager is running.
+
+        Extra keyword arguments are passed to Noon.
+        """
+        assert account_id not in self._accounts, "Account '{}' already added".format(account_id)
+        if self._session is None:
+            self._session = create_session()
+        account = NoonAccount(account_id, Noon(self._session, username, password, **kwargs))
+        account.noon.subscribe(self._handle_event, account_id)
+        self._accounts[account_id] = account
+        if self._running:
+            self._start_account(account)
+        return account.noon
+
+    async def remove_account(self, account_id: str):
+        """Stop and forget an account."""
+        account = self._accounts.pop(account_id)
+        await self._stop_account(account)
+
+    async def start(self):
+        """Start every account added so far."""
+        self._running = True
+        for account in self._accounts.values():
+            if account._task is None:
+                self._start_account(account)
+
+    async def stop(self):
+        """Stop every account, and close the session if the manager created it."""
+        self._running = False
+        await asyncio.gather(*[self._stop_account(account) for account in self._accounts.values()])
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def events(self) -> typing.AsyncIterator[NoonAccountEvent]:
+        """Yields events from every account as they arrive."""
+        while True:
+            yield await self._events.get()
+
+    def health(self) -> typing.Dict[str, typing.Dict]:
+        """Returns the health of each account, keyed by account ID."""
+        return {account_id: account.health() for account_id, account in self._accounts.items()}
+
+    def _start_account(self, account: NoonAccount):
+        """Schedule the start-up of an account in the next free login slot."""
+        now = time.monotonic()
+        delay = max(0, self._next_login - now)
+        self._next_login = now + delay + self._login_interval
+        account._task = asyncio.get_running_loop().create_task(self._run_account(account, delay))
+
+    async def _stop_account(self, account: NoonAccount):
+        if account._task is not None:
+            account._task.cancel()
+            try:
+                await account._task
+            except asyncio.CancelledError:
+                pass
+            account._task = None
+        await account.noon.close_eventstream()
+        account._state = ACCOUNT_STATE_STOPPED
+
+    async def _run_account(self, account: NoonAccount, delay: float):
+        """Start an account, then keep its event stream running."""
+        await asyncio.sleep(delay)
+        noon = account.noon
+        while True:
+            try:
+                if not account._discovered:
+                    async with self._semaphore:
+                        account._state = ACCOUNT_STATE_AUTHENTICATING
+                        await noon.authenticate()
+                        account._state = ACCOUNT_STATE_DISCOVERING
+                        await noon.start()
+                        account._discovered = True
+                else:
+                    """ Pick up anything that changed while the account was disconnected """
+                    await noon.reconnect()
+                account._state = ACCOUNT_STATE_CONNECTED
+                account._failures = 0
+                await asyncio.shield(noon._websocket_task)
+                account._last_error = noon.event_stream_error
+                _LOGGER.warning("Event stream for account '{}' stopped: {}".format(account.account_id, account._last_error))
+            except asyncio.CancelledError:
+                await noon.close_eventstream()
+                raise
+            except Exception as e:
+                _LOGGER.exception("Failed to start account '{}'".format(account.account_id))
+                account._last_error = "{}: {}".format(type(e).__name__, e)
+
+            account._failures = account._failures + 1
+            account._state = ACCOUNT_STATE_RECONNECTING if account._discovered else ACCOUNT_STATE_ERROR
+            backoff = min(self._max_reconnect_backoff, self._reconnect_backoff * (2 ** (account._failures - 1)))
+            await asyncio.sleep(backoff)
+
+    async def _handle_event(self, entity: NoonEntity, account_id: str, event: NoonEvent, params: typing.Dict):
+        """Add an event from one account to the merged feed."""
+        try:
+            self._events.put_nowait(NoonAccountEvent(account_id, entity, event, params))
+        except asyncio.QueueFull:
+            self._dropped_events = self._dropped_events + 1
@@ -0,0 +1,92 @@
+""" Runtime metrics for a Noon connection. """
+
+import time
+from collections import deque
+from typing import Deque, Iterable
+
+""" Number of dispatch latencies kept for percentiles """
+LATENCY_SAMPLES = 1000
+
+""" Window, in seconds, over which the event rate is measured """
+RATE_WINDOW = 10
+
+
+def sample_percentile(samples: Iterable[float], percentile: float) -> float:
+    """Returns the given percentile (0-100) of the samples, or None if there are none."""
+    ordered = sorted(samples)
+    if len(ordered) == 0:
+        return None
+    index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class NoonMetrics(object):
+    """Counters describing the event stream of a Noon connection."""
+
+    @property
+    def events(self) -> int:
+        """Returns the number of change notifications processed."""
+        return self._events
+
+    @property
+    def connects(self) -> int:
+        """Returns the number of times the event stream has connected."""
+        return self._connects
+
+    @property
+    def reconnects(self) -> int:
+        """Returns the number of times the event stream has connected after the first."""
+        return max(0, self._connects - 1)
+
+    @property
+    def last_event_at(self) -> float:
+        """Returns the wall-clock time of the last change notification, or None."""
+        return self._last_event_at
+
+    @property
+    def dispatch_latencies(self) -> Deque[float]:
+        """Returns recent per-change dispatch latencies, in seconds."""
+        return self._dispatch_latencies
+
+    @property
+    def events_per_second(self) -> float:
+        """Returns the change notification rate over the last few seconds."""
+        cutoff = int(time.monotonic()) - RATE_WINDOW
+        return sum(count for second, count in self._event_counts if second > cutoff) / RATE_WINDOW
+
+    def __init__(self):
+        """Initializes empty metrics."""
+        self._events = 0
+        self._connects = 0
+        self._last_event_at = None
+        self._dispatch_latencies = deque(maxlen=LATENCY_SAMPLES)
+        """ [second, count] per second, so memory does not grow with the event rate """
+        self._event_counts = deque(maxlen=RATE_WINDOW + 1)
+
+    def record_connect(self):
+        self._connects = self._connects + 1
+
+    def record_event(self, dispatch_latency: float):
+        self._events = self._events + 1
+        self._last_event_at = time.time()
+        self._dispatch_latencies.append(dispatch_latency)
+        second = int(time.monotonic())
+        if len(self._event_counts) > 0 and self._event_counts[-1][0] == second:
+            self._event_counts[-1][1] += 1
+        else:
+            self._event_counts.append([second, 1])
+
+    def dispatch_latency_percentile(self, percentile: float) -> float:
+        """Returns the given percentile (0-100) of recent dispatch latencies, or None."""
+        return sample_percentile(self._dispatch_latencies, percentile)
+
+    def as_dict(self):
+        """Returns the metrics as a plain dictionary."""
+        return {
+            "events": self._events,
+            "eventsPerSecond": self.events_per_second,
+            "reconnects": self.reconnects,
+            "lastEventAt": self._last_event_at,
+            "dispatchLatencyP50": self.dispatch_latency_percentile(50),
+            "dispatchLatencyP99": self.dispatch_latency_percentile(99),
+        }
@@ -1,29 +1,50 @@
 import logging
 import asyncio
 from asyncio import CancelledError
-from aiohttp import ClientSession, WSMsgType, ClientTimeout, WSServerHandshakeError
+from aiohttp import ClientSession, WSMsgType, WSServerHandshakeError, ClientConnectionError, ClientError
 import json
 import datetime
 import traceback
 import typing
+import itertools
+import random
+import time
+from collections import deque
 from .const import (
     LOGIN_URL,
     DEX_URL,
+    DIMMING_BAND_WIDTH,
     Guid
 )
-from .space import NoonSpace
-from .line import NoonLine
+from .space import NoonSpace, ATTR_LIGHTS_ON, SPACE_LIGHTS_STATE_ON, SPACE_LIGHTS_STATE_OFF
+from .line import NoonLine, ATTR_LINE_STATE, ATTR_DIM_LEVEL
 from .entity import NoonEntity
 from .scene import NoonScene
+from .zone import NoonZone
+from .command import NoonCommand
+from .planner import NoonPlanner
+from .metrics import NoonMetrics
+from .snapshot import NoonLineTable
+from .history import NoonHistory, DEFAULT_BUDGET
+from .versions import NoonChangeLog, NoonChanges
+from .polling import NoonPoller, state_changes, POLL_QUERY
+from .transport import NoonEndpoints, NOTIFICATION_HEARTBEAT, EVENTSTREAM_TIMEOUT, EVENTSTREAM_CONNECT_TIMEOUT
 from .exceptions import (
     NoonAuthenticationError,
     NoonUnknownError,
     NoonProtocolError,
-    NoonDuplicateIdError
+    NoonDuplicateIdError,
+    NoonCommunicationError,
+    NoonInvalidParametersError
 )
 
 _LOGGER = logging.getLogger(__name__)
 
+""" Unconfirmed commands are forgotten after this many seconds """
+COMMAND_EXPIRY = 60
+
+""" Number of command confirmation latencies to keep """
+COMMAND_LATENCY_HISTORY = 100
 
 
 class Noon(object):
@@ -41,6 +62,10 @@ class Noon(object):
             await self._refreshDevices()
         return self._lines
 
+    @property
+    def zones(self) -> typing.Dict[Guid, NoonZone]:
+        return self._zones
+
     @property
     def session(self) -> ClientSession:
         return self._session
@@ -53,11 +78,79 @@ class Noon(object):
     def event_stream_error(self) -> str:
         return self._event_stream_error
 
-    def __init__(self, session, username, password):
+    @property
+    def polling(self) -> bool:
+        """Returns True while changes are being polled for because the stream is down."""
+        return self._poller is not None and self._poller.running
+
+    @property
+    def optimistic(self) -> bool:
+        return self._optimistic
+
+    @property
+    def optimistic_timeout(self) -> float:
+        return self._optimistic_timeout
+
+    @property
+    def line_table(self) -> NoonLineTable:
+        """Returns the columnar table of line state, kept up to date by events."""
+        return self._line_table
+
+    @property
+    def history(self) -> NoonHistory:
+        """Returns the state history, or None if not enabled with enable_history()."""
+        return self._history
+
+    @property
+    def state_version(self) -> int:
+        """Returns the version of the most recent state change."""
+        return self._changelog.version
+
+    @property
+    def metrics(self) -> NoonMetrics:
+        return self._metrics
+
+    @property
+    def stream_backlog(self) -> int:
+        """Returns the number of notifications received but not yet applied, or None if unknown."""
+        return None
+
+    @property
+    def pending_command_count(self) -> int:
+        """Returns the number of commands awaiting confirmation."""
+        return len(self._pending_commands)
+
+    @property
+    def collapse_multiway_events(self) -> bool:
+        return self._collapse_multiway_events
+
+    @property
+    def command_latencies(self) -> typing.Deque[float]:
+        """Returns the most recent command-to-confirmation latencies, in seconds."""
+        return self._command_latencies
+
+    def __init__(self, session, username, password, optimistic: bool=False, optimistic_timeout: float=10,
+            action_retries: int=3, action_backoff: float=0.5, prewarm: bool=False,
+            collapse_multiway_events: bool=False, polling_fallback: bool=False, stream_retry_interval: float=30):
         """Create a PyNoone object.
 
         :param username: Noon username
         :param password: Noon password
+        :param optimistic: Update local state as soon as a command is accepted,
+            then confirm or revert it from the event stream
+        :param optimistic_timeout: Seconds to wait for confirmation before
+            reverting an optimistic change
+        :param action_retries: Times to retry an idempotent action after a
+            server error or dropped connection
+        :param action_backoff: Base delay, in seconds, between retries
+        :param prewarm: Open connections to the query and action hosts after
+            discovery, so the first command does not wait for TCP/TLS set-up
+        :param collapse_multiway_events: Only emit line events from the master
+            of each multiway group, rather than from every member
+        :param polling_fallback: Poll for changes while the notification
+            stream cannot connect, instead of stopping the event stream
+        :param stream_retry_interval: Seconds between attempts to reconnect
+            the notification stream while polling
 
         :returns PyNoon base object
         
@@ -68,15 +161,50 @@ class Noon(object):
         self._lines = None
         self._scenes = None
         self._all_entities = {}
+        self._zones = {}
+        self._reset_indexes()
         self._endpoints = {}
+        self._urls = None
+        self._prewarm = prewarm
+        self._collapse_multiway_events = collapse_multiway_events
+        self._polling_fallback = polling_fallback
+        self._stream_retry_interval = stream_retry_interval
+        self._poller = NoonPoller(self) if polling_fallback else None
         self._event_stream_connected = False
         self._event_stream_error = None
+        self._optimistic = optimistic
+        self._optimistic_timeout = optimistic_timeout
+
+        # Commands awaiting confirmation
+        self._tids = itertools.count(random.randint(1, 1 << 30))
+        self._pending_commands = {}
+        self._command_latencies = deque(maxlen=COMMAND_LATENCY_HISTORY)
+
+        # Subscribers to events from every entity
+        self._subscribers = []
+        self._metrics = NoonMetrics()
+        self._history = None
+        self._change_listeners = []
+        self._changelog = NoonChangeLog()
+
+        # Notifications received while discovery is running
+        self._discovering = False
+        self._early_changes = []
+
+        # Set while the event stream is connected, or the poller is running in its place
+        self._stream_ready = None
+        self._discovery_connects = None
 
         # Store credentials
         self._username = username
         self._password = password
         self._token = None
         self._token_expires = None
+        self._auth_headers = {}
+
+        # Action retries
+        self._action_retries = action_retries
+        self._action_backoff = action_backoff
 
         # AIOHTTP
         self._session = session
@@ -119,6 +247,7 @@ class Noon(object):
             try:
                 self._token = parsed_response["token"]
                 self._token_expires = datetime.datetime.now() + datetime.timedelta(seconds = (parsed_response["lifetime"]-30))
+                self._auth_headers = {"Authorization": "Token {}".format(self._token)}
                 _LOGGER.debug("Got token from Noon. Expires at {}".format(self._token_expires))
             except KeyError:
                 _LOGGER.error("Failed to get token or lifetime from {}".format(parsed_response))
@@ -130,14 +259,98 @@ class Noon(object):
             # Success
             return True
 
+    def _invalidate_token(self):
+        """Discard the cached token, forcing the next request to log in again."""
+        self._token = None
+        self._token_expires = None
+        self._auth_headers = {}
+
+
+
+    async def start(self, timeout: float=30) -> bool:
+        """Authenticate, then run discovery and connect the event stream concurrently.
 
+        Notifications that arrive before discovery completes are held and
+        applied once it has. If the stream was not yet connected when the
+        discovery query was sent, the snapshot may predate the stream
+        subscribing, so once it is connected the state is read again and any
+        differences are applied (see reconcile()).
+
+        :param timeout: Seconds to wait for the event stream to connect (or,
+            with polling_fallback, to fail over to polling)
+        """
+        await self.authenticate()
+        self._stream_ready = asyncio.Event()
+        await self.open_eventstream()
+        try:
+            await self._refreshDevices()
+            await self._wait_for_stream(timeout)
+            """ Held notifications cover a stream connected throughout discovery, and the poller catches up by itself """
+            if self._event_stream_connected and self._discovery_connects != self._metrics.connects:
+                await self.reconcile()
+        except BaseException:
+            await self.close_eventstream()
+            await asyncio.wait([self._websocket_task])
+            raise
+        return True
+
+    async def reconnect(self, timeout: float=30) -> int:
+        """Reconnect the event stream, then apply any changes made while it was down.
+
+        :param timeout: Seconds to wait for the event stream to connect
+
+        :returns The number of entities that changed while disconnected
+        """
+        await self.lines
+        if self._stream_ready is None:
+            self._stream_ready = asyncio.Event()
+        await self.open_eventstream()
+        try:
+            await self._wait_for_stream(timeout)
+            return await self.reconcile()
+        except BaseException:
+            await self.close_eventstream()
+            await asyncio.wait([self._websocket_task])
+            raise
+
+    async def _wait_for_stream(self, timeout: float):
+        """Wait for the stream to connect or fall back to polling, unless it has already given up."""
+        if not self._event_stream_connected and not self.polling:
+            ready = asyncio.ensure_future(self._stream_ready.wait())
+            await asyncio.wait([ready, self._websocket_task], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            ready.cancel()
+        if not self._event_stream_connected and not self.polling:
+            raise NoonProtocolError("Event stream failed to connect: {}".format(self._event_stream_error))
+
+    async def reconcile(self) -> int:
+        """Read the state of every space and line again, applying any changes the event stream missed.
+
+        Notifications are held while the state is fetched, then applied on
+        top of it, so a stale snapshot never overwrites a newer notification.
+
+        :returns The number of entities that changed
+        """
+        self._discovering = True
+        try:
+            changes = state_changes(self, await self._queryState())
+            for change in changes:
+                await self._apply_change(change, None)
+        finally:
+            self._discovering = False
+            early_changes = self._early_changes
+            self._early_changes = []
+        for change, tid in early_changes:
+            await self._handle_change(change, tid)
+        if len(changes) > 0:
+            _LOGGER.debug("Reconciled {} entities changed while the stream was down".format(len(changes)))
+        return len(changes)
 
     async def open_eventstream(self, event_loop=None):
         """Create a background task for the event stream."""
         if event_loop is None:
             _LOGGER.debug("Using main asyncio event loop")
             event_loop = asyncio.get_running_loop()
-        assert self._websocket_task is None or self._websocket_task.cancelled(), "Already running an event stream task"
+        assert self._websocket_task is None or self._websocket_task.done(), "Already running an event stream task"
         self._websocket_task = event_loop.create_task(self._internal_eventstream())
 
 
@@ -151,22 +364,29 @@ class Noon(object):
         """Loop for connecting to the Noon notification stream."""
         keep_looping = True
         while keep_looping:
+            stream_failed = False
             try:
                 await self.authenticate()
-                timeout = ClientTimeout(total=8, connect=20, sock_connect=20, sock_read=8)
-                event_stream_url = "{}/api/notifications".format(self._endpoints["notification-ws"])
                 _LOGGER.debug("Connecting to notification stream...")
-                async with self.session.ws_connect(event_stream_url, timeout=timeout, heartbeat=60, headers={"Authorization": "Token {}".format(self._token)}) as ws:
+                """ The handshake is bounded separately, as the stream timeouts only apply once connected """
+                ws = await asyncio.wait_for(self.session.ws_connect(self._urls.notifications, timeout=EVENTSTREAM_TIMEOUT,
+                    heartbeat=NOTIFICATION_HEARTBEAT, headers=self._auth_headers), EVENTSTREAM_CONNECT_TIMEOUT)
+                async with ws:
                     _LOGGER.debug("Connected to notification stream")
+                    self._metrics.record_connect()
                     self._event_stream_connected = True
+                    if self._stream_ready is not None:
+                        self._stream_ready.set()
                     self._event_stream_error = None
+                    if self.polling:
+                        await self._stop_polling()
                     async for msg in ws:
                         if msg.type == WSMsgType.TEXT:
                             _LOGGER.debug("Got websocket message: {}".format(msg.data))
                             parsed_data = json.loads(msg.data)
                             changes = parsed_data["data"].get("changes", [])
                             for change in changes:
-                                await self._handle_change(change)
+                                await self._handle_change(change, parsed_data["data"].get("tid", None))
                         elif msg.type == WSMsgType.CLOSED:
                             _LOGGER.error("Socket closed")
                             raise NoonProtocolError("Notification stream closed unexpectedly")
@@ -180,16 +400,43 @@ class Noon(object):
             except WSServerHandshakeError:
                 _LOGGER.error("Loop Fatal: Handshake error")
                 self._event_stream_error = "Handshake Error"
-                keep_looping = False
+                keep_looping = self._polling_fallback
+                stream_failed = True
             except Exception:
                 _LOGGER.exception("Loop Fatal: Generic exception during event loop")
                 self._event_stream_error = "Unknown exception - {}".format(traceback.format_exc())
-                keep_looping = False
+                keep_looping = self._polling_fallback
+                stream_failed = True
             finally:
                 _LOGGER.debug("Event stream is disconnected.")
                 self._event_stream_connected = False
+                if self._stream_ready is not None:
+                    self._stream_ready.clear()
+
+            """ Poll until the stream can be reconnected """
+            if keep_looping and stream_failed:
+                self._poller.start()
+                if self._stream_ready is not None:
+                    self._stream_ready.set()
+                try:
+                    await asyncio.sleep(self._stream_retry_interval)
+                except CancelledError:
+                    self._event_stream_error = "Canceled"
+                    keep_looping = False
+
+        if self._poller is not None:
+            await self._stop_polling(reconcile=False)
+
+    async def _stop_polling(self, reconcile: bool=True):
+        """Stop the polling fallback, reconciling to catch changes made before the stream connected."""
+        await self._poller.stop()
+        if reconcile:
+            try:
+                await self.reconcile()
+            except Exception:
+                _LOGGER.exception("Final poll after reconnecting failed")
 
-    async def _handle_change(self, change):
+    async def _handle_change(self, change, tid: int=None):
         """Process a change notification."""
 
         guid = change.get("guid", None)
@@ -197,18 +444,326 @@ class Noon(object):
             _LOGGER.error("Cannot process change - no GUID in {}".format(change))
             return
 
+        """ Hold changes until discovery (or a reconcile) has read the state """
+        if self._discovering:
+            _LOGGER.debug("Discovery in progress, holding change for {}".format(guid))
+            self._early_changes.append((change, tid))
+            return
+
+        await self._apply_change(change, tid)
+
+    async def _apply_change(self, change, tid: int):
+        """Apply a change notification to its entity, and tell the commands and listeners waiting on it."""
+        guid = change["guid"]
         affected_entity = self._all_entities.get(guid, None)
         if affected_entity is None:
             _LOGGER.debug("UNEXPECTED: Got change notification for {}, but not an expected entity! ({}".format(guid, change))
             return
 
         _LOGGER.debug("Got change notification for '{}' - {}".format(affected_entity.name, change))
+        started = time.monotonic()
         changed_fields = change.get("fields", [])
-        return await affected_entity.handle_update(changed_fields)
+        await affected_entity.handle_update(changed_fields)
+        self._match_commands(guid, changed_fields, change.get("tid", tid))
+        self._metrics.record_event(time.monotonic() - started)
+        for listener in self._change_listeners:
+            listener(change, tid)
+
+    def add_change_listener(self, listener: typing.Callable[[typing.Dict, int], None]):
+        """Call listener(change, tid) with each raw change notification once it has been applied."""
+        self._change_listeners.append(listener)
+
+    def remove_change_listener(self, listener: typing.Callable[[typing.Dict, int], None]):
+        self._change_listeners.remove(listener)
+
+    async def enable_history(self, budget: int=DEFAULT_BUDGET) -> NoonHistory:
+        """Start recording changes from the event stream into per-entity ring buffers.
+
+        :param budget: Total number of samples kept, shared between the spaces and lines
+        """
+        if self._history is None:
+            spaces = await self.spaces
+            lines = await self.lines
+            self._history = NoonHistory(len(spaces) + len(lines), budget)
+        return self._history
+
+    def changes_since(self, version: int) -> NoonChanges:
+        """Returns the (version, guid, field, value) changes made after version.
+
+        Pass the returned version to the next call. If reset is set, the
+        state was rediscovered or compacted since version, and should be
+        re-read in full.
+        """
+        return self._changelog.changes_since(version)
+
+    def entity_version(self, entity_id: Guid) -> int:
+        """Returns the state version at which an entity last changed, or None."""
+        return self._changelog.entity_version(entity_id)
+
+    def subscribe(self, handler, context):
+        """Subscribes to events from every entity on this account.
+
+        handler is called exactly as for NoonEntity.subscribe.
+        """
+        self._subscribers.append((handler, context))
+
+    def unsubscribe(self, handler, context):
+        """Remove a handler added with subscribe()."""
+        self._subscribers.remove((handler, context))
+
+    async def _dispatch_event(self, entity: NoonEntity, event, params: typing.Dict):
+        """Dispatches an entity event to the account-wide subscribers."""
+        for handler, context in self._subscribers:
+            try:
+                await handler(entity, context, event, params)
+            except:
+                _LOGGER.exception("Exception handling update for {}".format(entity.name))
+
+    async def _send_command(self, entity: NoonEntity, action: str, payload: typing.Dict, expected: typing.Dict) -> NoonCommand:
+        """Send an action to Noon, and track it until its effect is seen."""
+
+        """ Register before sending, as the notification can beat the response """
+        command = NoonCommand(next(self._tids), entity.guid, expected)
+        payload["tid"] = command.tid
+        self._pending_commands[command.tid] = command
+        try:
+            await self._post_action(action, payload)
+        except BaseException:
+            del self._pending_commands[command.tid]
+            raise
+
+        """ Give up on the command if no notification ever confirms it """
+        if not command.done:
+            command._expiry = asyncio.get_running_loop().call_later(COMMAND_EXPIRY, self._expire_command, command)
+
+        """ Poll promptly for the result if the stream is down """
+        if self.polling:
+            self._poller.poke()
+
+        """ Nothing to wait for if the target is already in the requested state """
+        if len(expected) == 0:
+            self._resolve_command(command, True)
+        return command
+
+    async def _post_action(self, action: str, payload: typing.Dict, idempotent: bool=True):
+        """Post an action to Noon.
+
+        Re-authenticates once if the token is rejected and, for idempotent
+        actions, retries server errors, dropped connections and timeouts with jittered
+        backoff. Failures are raised as NoonException subclasses.
+        """
+        attempt = 0
+        reauthenticated = False
+        while True:
+            try:
+                await self.authenticate()
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                """ Nothing has been sent yet, so logging in again is safe even for non-idempotent actions """
+                if attempt >= self._action_retries:
+                    raise NoonCommunicationError("Failed to log in to send {}: {}".format(action, e)) from e
+                attempt = attempt + 1
+                _LOGGER.debug("Error logging in to send {}, retrying ({}/{})".format(action, attempt, self._action_retries))
+                self._invalidate_token()
+                await self._backoff(attempt)
+                continue
+            try:
+                async with self.session.post(self._urls.action(action), headers=self._auth_headers, json=payload) as raw_response:
+                    status = raw_response.status
+                    _LOGGER.debug("Got {} result {}: {}".format(action, status, raw_response))
+            except (ClientError, asyncio.TimeoutError) as e:
+                """ Covers dropped connections, timeouts and truncated responses, none of which say whether the action ran """
+                if not idempotent or attempt >= self._action_retries:
+                    raise NoonCommunicationError("Failed to send {}: {}".format(action, str(e) or type(e).__name__)) from e
+                attempt = attempt + 1
+                _LOGGER.debug("Error sending {} ({}), retrying ({}/{})".format(action, type(e).__name__, attempt,
+                    self._action_retries))
+                await self._backoff(attempt)
+                continue
+
+            if status < 300:
+                return
+            elif status == 401 and not reauthenticated:
+                _LOGGER.debug("Token rejected sending {}, re-authenticating".format(action))
+                self._invalidate_token()
+                reauthenticated = True
+            elif status in (401, 403):
+                raise NoonAuthenticationError("Not authorized to send {}".format(action))
+            elif status >= 500:
+                if not idempotent or attempt >= self._action_retries:
+                    raise NoonCommunicationError("Server error {} sending {}".format(status, action))
+                attempt = attempt + 1
+                _LOGGER.debug("Server error {} sending {}, retrying ({}/{})".format(status, action, attempt, self._action_retries))
+                await self._backoff(attempt)
+            elif status in (400, 404, 422):
+                raise NoonInvalidParametersError("Noon rejected {} with status {}".format(action, status))
+            else:
+                raise NoonUnknownError("Unexpected status {} sending {}".format(status, action))
+
+    async def _backoff(self, attempt: int):
+        """Sleep before a retry, with full jitter."""
+        await asyncio.sleep(random.uniform(0, self._action_backoff * (2 ** (attempt - 1))))
+
+    def _match_commands(self, guid: Guid, changed_fields: typing.List, tid: int=None):
+        """Match a change notification back to the command(s) that caused it."""
+
+        """ Noon echoed the transaction ID """
+        command = self._pending_commands.get(tid, None) if tid is not None else None
+        if command is not None:
+            self._resolve_command(command, True)
+            return
+
+        """ Otherwise, each changed field confirms the oldest command waiting on that value """
+        remaining = {field["name"]: self._field_value(field["value"]) for field in changed_fields}
+        for command in list(self._pending_commands.values()):
+            if len(remaining) == 0:
+                break
+            if command.target != guid:
+                continue
+            for name in command._observe(remaining):
+                del remaining[name]
+            if command.done:
+                self._resolve_command(command, True)
+
+    def _resolve_command(self, command: NoonCommand, applied: bool):
+        self._pending_commands.pop(command.tid, None)
+        command._complete(applied)
+        if applied:
+            self._command_latencies.append(command.latency)
+
+    def _expire_command(self, command: NoonCommand):
+        """Forget a command that was never confirmed."""
+        if self._pending_commands.get(command.tid, None) is command:
+            _LOGGER.debug("Command {} was never confirmed".format(command.tid))
+            self._resolve_command(command, False)
+
+    @staticmethod
+    def _field_value(value):
+        """Returns a notified field value in the form commands expect (e.g. a scene GUID, not a dictionary)."""
+        if isinstance(value, dict):
+            return value.get("guid", None)
+        if value == SPACE_LIGHTS_STATE_ON or value == SPACE_LIGHTS_STATE_OFF:
+            return value == SPACE_LIGHTS_STATE_ON
+        return value
 
     def get_entity(self, entity_id: Guid) -> NoonEntity:
         return self._all_entities.get(entity_id, None)
 
+    def lines_named(self, name: str) -> typing.List[NoonLine]:
+        """Returns the lines with the given name, in any space."""
+        return list(self._lines_by_name.get(name, {}).values())
+
+    def lines_in_space(self, space_id: Guid) -> typing.List[NoonLine]:
+        """Returns the lines in the given space."""
+        return list(self._lines_by_space.get(space_id, {}).values())
+
+    def scenes_named(self, name: str) -> typing.List[NoonScene]:
+        """Returns the scenes with the given name, in any space."""
+        return list(self._scenes_by_name.get(name, {}).values())
+
+    def lines_with_state(self, line_state: str) -> typing.List[NoonLine]:
+        """Returns the lines whose line_state is currently line_state (e.g. 'on')."""
+        return list(self._lines_by_state.get(line_state, {}).values())
+
+    def lines_in_dimming_range(self, minimum: int, maximum: int) -> typing.List[NoonLine]:
+        """Returns the lines whose dimming level is between minimum and maximum, inclusive."""
+        result = []
+        for band in range(minimum // DIMMING_BAND_WIDTH, maximum // DIMMING_BAND_WIDTH + 1):
+            for line in self._lines_by_dimming_band.get(band, {}).values():
+                if minimum <= line.dimming_level <= maximum:
+                    result.append(line)
+        return result
+
+    def spaces_with_lights_on(self, lights_on: bool=True) -> typing.List[NoonSpace]:
+        """Returns the spaces whose lights are currently on (or off)."""
+        return list(self._spaces_by_lights_on.get(lights_on, {}).values())
+
+    async def set_states(self, lines: typing.Dict=None, spaces: typing.Dict=None,
+            transition_time: int=None) -> typing.List[NoonCommand]:
+        """Bring lines and spaces to a desired state using as few actions as possible.
+
+        :param lines: Desired brightness (0 for off) for each line or line GUID
+        :param spaces: Desired lights-on state for each space or space GUID
+        """
+        await self.lines
+        return await NoonPlanner(self).execute(lines, spaces, transition_time)
+
+    async def add_zone(self, name: str, lines: typing.List=None, spaces: typing.List=None, guid: Guid=None) -> NoonZone:
+        """Create a zone from lines and spaces (or their GUIDs), discovering devices first if needed."""
+        await self.lines
+        line_ids = [line.guid if isinstance(line, NoonLine) else line for line in (lines or [])]
+        space_ids = [space.guid if isinstance(space, NoonSpace) else space for space in (spaces or [])]
+        if guid is not None and guid in self._all_entities:
+            raise NoonDuplicateIdError("Entity '{}' already exists".format(guid))
+        zone = NoonZone(self, name, line_ids, space_ids, guid)
+        self._zones[zone.guid] = zone
+        zone._bind()
+        return zone
+
+    def remove_zone(self, zone: NoonZone):
+        """Remove a zone, unsubscribing it from its lines."""
+        zone._unbind()
+        self._zones.pop(zone.guid, None)
+        self._all_entities.pop(zone.guid, None)
+
+    def _reset_indexes(self):
+        """Clear the lookup indexes over the entity graph."""
+        self._lines_by_name = {}
+        self._lines_by_space = {}
+        self._scenes_by_name = {}
+        self._lines_by_state = {}
+        self._lines_by_dimming_band = {}
+        self._spaces_by_lights_on = {}
+        self._line_table = NoonLineTable()
+
+    @staticmethod
+    def _dimming_band(dimming_level: int):
+        return None if dimming_level is None else dimming_level // DIMMING_BAND_WIDTH
+
+    @staticmethod
+    def _index_add(index: typing.Dict, key, entity: NoonEntity):
+        index.setdefault(key, {})[entity.guid] = entity
+
+    @staticmethod
+    def _index_remove(index: typing.Dict, key, entity: NoonEntity):
+        bucket = index.get(key, None)
+        if bucket is not None:
+            bucket.pop(entity.guid, None)
+            if len(bucket) == 0:
+                del index[key]
+
+    def _index_entity(self, entity: NoonEntity):
+        """Add a newly registered entity to the lookup indexes."""
+        if isinstance(entity, NoonLine):
+            self._index_add(self._lines_by_name, entity.name, entity)
+            if entity.parent_space is not None:
+                self._index_add(self._lines_by_space, entity.parent_space.guid, entity)
+            self._index_add(self._lines_by_state, entity.line_state, entity)
+            self._index_add(self._lines_by_dimming_band, self._dimming_band(entity.dimming_level), entity)
+            self._line_table.add_line(entity.guid, entity.parent_space.guid if entity.parent_space is not None else None,
+                entity.line_state, entity.dimming_level)
+        elif isinstance(entity, NoonScene):
+            self._index_add(self._scenes_by_name, entity.name, entity)
+        elif isinstance(entity, NoonSpace):
+            self._index_add(self._spaces_by_lights_on, entity.lights_on, entity)
+
+    def _entity_field_changed(self, entity: NoonEntity, field: str, old_value, new_value):
+        """Called by entities when one of their fields changes value."""
+        self._changelog.record(entity.guid, field, new_value)
+        if field == ATTR_LINE_STATE:
+            self._index_remove(self._lines_by_state, old_value, entity)
+            self._index_add(self._lines_by_state, new_value, entity)
+            self._line_table.set_line_state(entity.guid, new_value)
+        elif field == ATTR_DIM_LEVEL:
+            self._line_table.set_dimming_level(entity.guid, new_value)
+            old_band = self._dimming_band(old_value)
+            new_band = self._dimming_band(new_value)
+            if old_band != new_band:
+                self._index_remove(self._lines_by_dimming_band, old_band, entity)
+                self._index_add(self._lines_by_dimming_band, new_band, entity)
+        elif field == ATTR_LIGHTS_ON:
+            self._index_remove(self._spaces_by_lights_on, old_value, entity)
+            self._index_add(self._spaces_by_lights_on, new_value, entity)
+
     async def _refreshEndpoints(self):
         """Update the noon endpoints for this account"""
         
@@ -216,9 +771,7 @@ class Noon(object):
             return
 
         await self.authenticate()
-        async with self.session.get(DEX_URL, headers={
-            "Authorization": "Token {}".format(self._token)
-        }) as login_response:
+        async with self.session.get(DEX_URL, headers=self._auth_headers) as login_response:
             parsed_response = await login_response.json()
 
             # Must be a dictionary
@@ -229,10 +782,21 @@ class Noon(object):
             # Store
             try:
                 self._endpoints = parsed_response["endpoints"]
+                self._urls = NoonEndpoints(self._endpoints)
             except KeyError:
                 _LOGGER.error("Unexpected endpoints response {}".format(parsed_response))
                 raise NoonUnknownError
 
+    async def prewarm_connections(self):
+        """Open (or refresh) pooled connections to the query and action hosts."""
+        await self.authenticate()
+        for host in self._urls.hosts:
+            try:
+                async with self.session.head(host) as response:
+                    _LOGGER.debug("Pre-warmed connection to {} ({})".format(host, response.status))
+            except ClientConnectionError:
+                _LOGGER.warning("Failed to pre-warm connection to {}".format(host))
+
     def _registerEntity(self, entity: NoonEntity):
 
         """ EVERYTHING """
@@ -274,33 +838,93 @@ class Noon(object):
             else:
                 self._scenes[entity.guid] = entity	
 
+        self._index_entity(entity)
+
+    def _linkMultiwayGroups(self):
+        """Connect each multiway slave line to its master."""
+        for line in self._lines.values():
+            if line._multiway_master_id is None:
+                continue
+            master = self._lines.get(line._multiway_master_id, None)
+            if master is None:
+                _LOGGER.warning("Multiway master {} for line '{}' not found".format(line._multiway_master_id, line.name))
+                continue
+            line._multiway_master = master
+            master._multiway_members[line.guid] = line
+
     async def _refreshDevices(self):
+        """Load the devices (spaces/lines) on this account, then apply any changes received meanwhile."""
+        self._discovering = True
+        try:
+            await self._loadDevices()
+        finally:
+            self._discovering = False
+            early_changes = self._early_changes
+            self._early_changes = []
+        for change, tid in early_changes:
+            await self._handle_change(change, tid)
+
+    async def _loadDevices(self):
         """Load the devices (spaces/lines) on this account."""
 
+        # Load the device details, noting whether the event stream is already subscribed
+        self._discovery_connects = self._metrics.connects if self._event_stream_connected else None
+        parsed_response = await self._queryDevices()
+
+        # Must be a dictionary
+        if not isinstance(parsed_response, dict):
+            _LOGGER.error("Response from discovery was not a dictionary - {}".format(parsed_response))
+            raise NoonProtocolError
+
         # Reset cache
         self._spaces = {}
         self._scenes = {}
         self._lines = {}
+        self._reset_indexes()
+        self._changelog.reset()
+
+        # Parse spaces
+        for space in parsed_response["spaces"]:
+            this_space = await NoonSpace.from_json(self, space)
+            _LOGGER.debug("Discovered space {}".format(this_space.name))
+
+        # Link multiway slaves to their masters
+        self._linkMultiwayGroups()
+
+        # Point zones at the new lines
+        for zone in self._zones.values():
+            zone._bind()
+
+        # Open connections ready for the first command
+        if self._prewarm:
+            await self.prewarm_connections()
+
+    async def _queryDevices(self) -> typing.Dict:
+        """Fetch the spaces, lines and scenes on this account from Noon."""
 
         # Authenticate if needed
         await self.authenticate()
 
-        # Load the device details
-        url = "{}/api/query".format(self._endpoints["query"])
-        headers = {
-            "Authorization": "Token {}".format(self._token),
-            "Content-Type": "application/graphql"
-        }
+        headers = dict(self._auth_headers)
+        headers["Content-Type"] = "application/graphql"
         data = "{spaces {guid name lightsOn activeScene{guid name} lines{guid lineState displayName dimmingLevel multiwayMaster { guid }} scenes{name guid}}}"
-        async with self.session.post(url, headers=headers, data=data) as discovery_response:
-            parsed_response = await discovery_response.json()
+        async with self.session.post(self._urls.query, headers=headers, data=data) as discovery_response:
+            return await discovery_response.json()
 
-            # Must be a dictionary
-            if not isinstance(parsed_response, dict):
-                _LOGGER.error("Response from discovery was not a dictionary - {}".format(parsed_response))
-                raise NoonProtocolError
-
-            # Parse spaces
-            for space in parsed_response["spaces"]:
-                this_space = await NoonSpace.from_json(self, space)
-                _LOGGER.debug("Discovered space {}".format(this_space.name))
\ No newline at end of file
+    async def _queryState(self) -> typing.Dict:
+        """Fetch only the fields that change at runtime (state, levels and scenes) in discovery form."""
+        await self.authenticate()
+        headers = dict(self._auth_headers)
+        headers["Content-Type"] = "application/graphql"
+        async with self.session.post(self._urls.query, headers=headers, data=POLL_QUERY) as response:
+            if response.status == 401:
+                self._invalidate_token()
+                raise NoonProtocolError("Token rejected while querying state")
+            parsed_response = await response.json()
+        if not isinstance(parsed_response, dict):
+            raise NoonProtocolError("Response from state query was not a dictionary - {}".format(parsed_response))
+        return parsed_response
+
+    def to_json(self) -> typing.Dict:
+        """Returns the current spaces, lines and scenes in the same form as discovery."""
+        return {"spaces": [space.to_json() for space in (self._spaces or {}).values()]}
@@ -0,0 +1,134 @@
+""" Planning bulk state changes with as few actions as possible. """
+
+import asyncio
+import logging
+import typing
+
+from .command import NoonCommand
+from .const import Guid
+from .exceptions import NoonInvalidParametersError
+from .line import NoonLine, LINE_STATE_ON, LINE_STATE_OFF
+from .space import NoonSpace
+
+_LOGGER = logging.getLogger(__name__)
+
+LineTargets = typing.Dict[typing.Union[NoonLine, Guid], int]
+SpaceTargets = typing.Dict[typing.Union[NoonSpace, Guid], bool]
+
+
+class NoonPlannedAction(object):
+    """A single action chosen by the planner."""
+
+    @property
+    def entity(self):
+        """Returns the space or line the action is sent to."""
+        return self._entity
+
+    @property
+    def value(self):
+        """Returns the brightness (for a line) or lights-on state (for a space)."""
+        return self._value
+
+    def __init__(self, entity, value, transition_time: int=None):
+        self._entity = entity
+        self._value = value
+        self._transition_time = transition_time
+
+    async def execute(self) -> NoonCommand:
+        """Send the action."""
+        if isinstance(self._entity, NoonSpace):
+            return await self._entity.set_scene(active=self._value)
+        return await self._entity.set_brightness(self._value, self._transition_time)
+
+    def __repr__(self):
+        """Returns a stringified representation of this object."""
+        return str({'entity': self._entity.guid, 'value': self._value})
+
+
+class NoonPlanner(object):
+    """Works out the fewest actions that bring lines and spaces to a desired state.
+
+    Lines already in the desired state are skipped (unless a space action
+    will change them), multiway slaves are folded into their master, and a
+    space whose lines are all to be turned off is switched off with a single
+    space action.
+    """
+
+    def __init__(self, noon):
+        self._noon = noon
+
+    def plan(self, lines: LineTargets=None, spaces: SpaceTargets=None,
+            transition_time: int=None) -> typing.List[NoonPlannedAction]:
+        """Returns the actions needed to reach the desired state, space actions first.
+
+        :param lines: Desired brightness (0 for off) for each line or line GUID
+        :param spaces: Desired lights-on state for each space or space GUID
+        :param transition_time: Transition time for line actions
+        """
+        line_targets = {}
+        for line, level in (lines or {}).items():
+            line = self._resolve(line, NoonLine)
+            line_targets[line.multiway_master or line] = level
+        space_targets = {self._resolve(space, NoonSpace): active for space, active in (spaces or {}).items()}
+
+        """ Spaces whose lines are all being turned off can be turned off in one go """
+        for space in set(line.parent_space for line in line_targets if line.parent_space is not None):
+            if space in space_targets:
+                continue
+            space_lines = set(line.multiway_master or line for line in self._noon.lines_in_space(space.guid))
+            if len(space_lines) > 1 and all(line_targets.get(line, None) == 0 for line in space_lines):
+                space_targets[space] = False
+
+        actions = []
+        covered = set()
+        changed_spaces = set()
+        for space, active in space_targets.items():
+            if active:
+                if space.lights_on is not True:
+                    actions.append(NoonPlannedAction(space, True))
+                    changed_spaces.add(space)
+                continue
+            space_lines = self._noon.lines_in_space(space.guid)
+            covered.update(space_lines)
+            if space.lights_on is not False or any(line.line_state != LINE_STATE_OFF for line in space_lines):
+                actions.append(NoonPlannedAction(space, False))
+                changed_spaces.add(space)
+
+        for line, level in line_targets.items():
+            if level == 0 and line in covered:
+                continue
+            """ A space action will change its lines, so their current state says nothing about the outcome """
+            if line.parent_space not in changed_spaces and self._line_satisfied(line, level):
+                continue
+            actions.append(NoonPlannedAction(line, level, transition_time))
+
+        _LOGGER.debug("Planned {} actions for {} lines and {} spaces".format(len(actions), len(line_targets), len(space_targets)))
+        return actions
+
+    async def execute(self, lines: LineTargets=None, spaces: SpaceTargets=None,
+            transition_time: int=None) -> typing.List[NoonCommand]:
+        """Plan and send the actions needed to reach the desired state.
+
+        Space actions are sent concurrently first, then line actions (which
+        may refine a scene just activated) are sent concurrently.
+        """
+        actions = self.plan(lines, spaces, transition_time)
+        space_actions = [action for action in actions if isinstance(action.entity, NoonSpace)]
+        line_actions = [action for action in actions if isinstance(action.entity, NoonLine)]
+        commands = list(await asyncio.gather(*[action.execute() for action in space_actions]))
+        commands.extend(await asyncio.gather(*[action.execute() for action in line_actions]))
+        return commands
+
+    @staticmethod
+    def _line_satisfied(line: NoonLine, level: int) -> bool:
+        if level == 0:
+            return line.line_state == LINE_STATE_OFF
+        return line.line_state == LINE_STATE_ON and line.dimming_level == level
+
+    def _resolve(self, entity, expected_type):
+        if isinstance(entity, expected_type):
+            return entity
+        resolved = self._noon.get_entity(entity)
+        if not isinstance(resolved, expected_type):
+            raise NoonInvalidParametersError("'{}' is not a known {}".format(entity, expected_type.__name__))
+        return resolved
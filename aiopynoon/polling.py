@@ -0,0 +1,141 @@
+""" Polling fallback for when the notification stream is unavailable. """
+
+import asyncio
+import logging
+import typing
+
+from .line import NoonLine, ATTR_LINE_STATE, ATTR_DIM_LEVEL
+from .space import NoonSpace, ATTR_LIGHTS_ON, ATTR_ACTIVE_SCENE, SPACE_LIGHTS_STATE_ON, SPACE_LIGHTS_STATE_OFF
+
+_LOGGER = logging.getLogger(__name__)
+
+""" Only the fields that change at runtime """
+POLL_QUERY = "{spaces {guid lightsOn activeScene{guid} lines{guid lineState dimmingLevel}}}"
+
+""" Seconds between polls just after a command or a change """
+MIN_INTERVAL = 2
+
+""" Seconds between polls when nothing is happening """
+MAX_INTERVAL = 60
+
+""" Factor by which the interval grows after each quiet poll """
+INTERVAL_GROWTH = 1.5
+
+
+def state_changes(noon, state: typing.Dict) -> typing.List[typing.Dict]:
+    """Returns change notifications for every space and line whose state differs from a discovery-form snapshot."""
+    changes = []
+    for space_json in state.get("spaces", []):
+        space = noon.get_entity(space_json.get("guid", None))
+        if isinstance(space, NoonSpace):
+            fields = []
+            lights_on = space_json.get("lightsOn", None)
+            if lights_on == SPACE_LIGHTS_STATE_ON or lights_on == SPACE_LIGHTS_STATE_OFF:
+                lights_on = (lights_on == SPACE_LIGHTS_STATE_ON)
+            if lights_on is not None and lights_on != space.lights_on:
+                fields.append({"name": ATTR_LIGHTS_ON, "value": lights_on})
+            active_scene = (space_json.get("activeScene", None) or {}).get("guid", None)
+            if active_scene is not None and active_scene != space.active_scene_id:
+                fields.append({"name": ATTR_ACTIVE_SCENE, "value": {"guid": active_scene}})
+            if len(fields) > 0:
+                changes.append({"guid": space.guid, "fields": fields})
+
+        for line_json in space_json.get("lines", None) or []:
+            line = noon.get_entity(line_json.get("guid", None))
+            if not isinstance(line, NoonLine):
+                continue
+            fields = []
+            if line_json.get("lineState", None) is not None and line_json["lineState"] != line.line_state:
+                fields.append({"name": ATTR_LINE_STATE, "value": line_json["lineState"]})
+            if line_json.get("dimmingLevel", None) is not None and line_json["dimmingLevel"] != line.dimming_level:
+                fields.append({"name": ATTR_DIM_LEVEL, "value": line_json["dimmingLevel"]})
+            if len(fields) > 0:
+                changes.append({"guid": line.guid, "fields": fields})
+    return changes
+
+
+class NoonPoller(object):
+    """Polls Noon for state changes and applies them as if they came from the stream.
+
+    The interval drops to min_interval after a command or an observed
+    change, and grows towards max_interval while nothing changes.
+    """
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def interval(self) -> float:
+        """Returns the current polling interval, in seconds."""
+        return self._interval
+
+    def __init__(self, noon, min_interval: float=MIN_INTERVAL, max_interval: float=MAX_INTERVAL,
+            growth: float=INTERVAL_GROWTH):
+        self._noon = noon
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._growth = growth
+        self._interval = min_interval
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+
+    def start(self):
+        """Start polling in the background."""
+        if self.running:
+            return
+        _LOGGER.info("Notification stream unavailable, polling for changes")
+        self._interval = self._min_interval
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop polling."""
+        if self._task is None:
+            return
+        """ wait_for() can swallow a cancellation that races its timeout, so also ask the loop to exit """
+        self._stopping = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def poke(self):
+        """Poll soon, and quickly for a while (e.g. after sending a command)."""
+        self._interval = self._min_interval
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                changed = await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _LOGGER.exception("Polling for changes failed")
+                changed = 0
+            if changed > 0:
+                self._interval = self._min_interval
+            else:
+                self._interval = min(self._max_interval, self._interval * self._growth)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def poll_once(self) -> int:
+        """Fetch the current state, apply any differences, and return how many entities changed."""
+        state = await self._noon._queryState()
+        changes = state_changes(self._noon, state)
+        for change in changes:
+            await self._noon._handle_change(change)
+        if len(changes) > 0:
+            _LOGGER.debug("Polling found {} changed entities".format(len(changes)))
+        return len(changes)
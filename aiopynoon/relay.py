@@ -0,0 +1,270 @@
+""" Sharing one Noon connection between local processes. """
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import traceback
+import typing
+
+from . import exceptions
+from .exceptions import NoonCommunicationError, NoonProtocolError
+from .noon import Noon
+
+_LOGGER = logging.getLogger(__name__)
+
+""" Changes buffered for a client before it is disconnected as too slow """
+CLIENT_QUEUE_SIZE = 10000
+
+""" Largest message accepted on the relay socket """
+MESSAGE_LIMIT = 16 * 1024 * 1024
+
+""" Actions clients may send upstream """
+RELAY_ACTIONS = ("line/lightLevel", "space/scene")
+
+""" Seconds to wait for a reply from the relay """
+REQUEST_TIMEOUT = 30
+
+
+def _encode(message: typing.Dict) -> bytes:
+    return json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class NoonRelayServer(object):
+    """Serves a Noon account's state and notifications to local clients over a Unix socket.
+
+    The Noon object should already be started (see Noon.start()). Each
+    client can request a snapshot in discovery form, subscribe to raw change
+    notifications and send actions, which are forwarded upstream.
+
+    Messages are newline-delimited JSON:
+        {"id": 1, "op": "snapshot"} -> {"id": 1, "result": {"spaces": [...]}}
+        {"id": 2, "op": "action", "action": "line/lightLevel", "payload": {...}} -> {"id": 2, "result": null}
+        {"id": 3, "op": "subscribe"} -> {"id": 3, "result": null}, then {"change": {...}, "tid": ...}
+    Failures are returned as {"id": n, "error": "<NoonException subclass>", "message": "..."}.
+
+    Only the actions in RELAY_ACTIONS are forwarded, and the socket is only
+    accessible to the user running the relay.
+    """
+
+    @property
+    def clients(self) -> int:
+        return len(self._clients)
+
+    def __init__(self, noon: Noon, path: str):
+        self._noon = noon
+        self._path = path
+        self._server = None
+        self._clients = set()
+        self._handlers = set()
+
+    async def start(self):
+        """Listen for clients."""
+        """ Clients act with the account's credentials, so the socket must not be created accessible to others """
+        umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle_client, self._path, limit=MESSAGE_LIMIT)
+        finally:
+            os.umask(umask)
+        os.chmod(self._path, 0o600)
+        self._noon.add_change_listener(self._handle_change)
+        _LOGGER.debug("Relay listening on {}".format(self._path))
+
+    async def stop(self):
+        """Stop listening and disconnect every client."""
+        self._noon.remove_change_listener(self._handle_change)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for handler in list(self._handlers):
+            handler.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def _handle_change(self, change: typing.Dict, tid: int):
+        """Fan a change out to every subscribed client."""
+        message = _encode({"change": change, "tid": tid})
+        for queue in list(self._clients):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                _LOGGER.warning("Relay client is not keeping up, disconnecting it")
+                self._clients.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        sender = asyncio.ensure_future(self._send_to_client(queue, writer))
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                asyncio.ensure_future(self._handle_request(request, queue))
+        except (ConnectionError, ValueError):
+            _LOGGER.debug("Relay client disconnected")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._handlers.discard(handler)
+            self._clients.discard(queue)
+            sender.cancel()
+            writer.close()
+
+    async def _send_to_client(self, queue: asyncio.Queue, writer: asyncio.StreamWriter):
+        while True:
+            message = await queue.get()
+            if message is None:
+                writer.close()
+                return
+            writer.write(message)
+            await writer.drain()
+
+    async def _handle_request(self, request: typing.Dict, queue: asyncio.Queue):
+        reply = {"id": request.get("id", None) if isinstance(request, dict) else None, "result": None}
+        try:
+            if not isinstance(request, dict):
+                raise exceptions.NoonInvalidParametersError("Request must be an object")
+            op = request.get("op", None)
+            if op == "snapshot":
+                await self._noon.lines
+                reply["result"] = self._noon.to_json()
+            elif op == "action":
+                action = request.get("action", None)
+                payload = request.get("payload", None)
+                if action not in RELAY_ACTIONS:
+                    raise exceptions.NoonInvalidParametersError("Action '{}' is not allowed".format(action))
+                if not isinstance(payload, dict):
+                    raise exceptions.NoonInvalidParametersError("Action payload must be an object")
+                await self._noon._post_action(action, payload)
+            elif op == "subscribe":
+                self._clients.add(queue)
+            else:
+                raise exceptions.NoonInvalidParametersError("Unknown op '{}'".format(op))
+        except exceptions.NoonException as e:
+            reply = {"id": reply["id"], "error": type(e).__name__, "message": str(e)}
+        except Exception as e:
+            _LOGGER.exception("Relay request failed")
+            reply = {"id": reply["id"], "error": "NoonUnknownError", "message": str(e)}
+        try:
+            queue.put_nowait(_encode(reply))
+        except asyncio.QueueFull:
+            pass
+
+
+class NoonRelayClient(Noon):
+    """A Noon that attaches to a NoonRelayServer instead of the Noon cloud.
+
+    Entities, subscriptions, commands and the event stream work as for Noon;
+    there is no login, and discovery and actions go through the relay.
+    """
+
+    @property
+    def stream_backlog(self) -> int:
+        return self._relay_changes.qsize() if self._relay_changes is not None else 0
+
+    def __init__(self, path: str, **kwargs):
+        """Create a client for the relay listening on path.
+
+        Extra keyword arguments are passed to Noon.
+        """
+        super().__init__(None, None, None, **kwargs)
+        self._relay_path = path
+        self._relay_writer = None
+        self._relay_reader_task = None
+        self._relay_requests = {}
+        self._relay_request_ids = itertools.count()
+        self._relay_changes = None
+
+    async def authenticate(self) -> bool:
+        """Connect to the relay if not already connected."""
+        if self._relay_writer is None or self._relay_writer.is_closing():
+            reader, self._relay_writer = await asyncio.open_unix_connection(self._relay_path, limit=MESSAGE_LIMIT)
+            self._relay_changes = asyncio.Queue()
+            self._relay_reader_task = asyncio.ensure_future(self._read_relay(reader))
+        return True
+
+    async def close(self):
+        """Disconnect from the relay."""
+        await self.close_eventstream()
+        if self._relay_writer is not None:
+            self._relay_writer.close()
+            self._relay_writer = None
+
+    async def _read_relay(self, reader: asyncio.StreamReader):
+        """Route replies to their requests, and changes to the event stream."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if "change" in message:
+                    self._relay_changes.put_nowait(message)
+                    continue
+                future = self._relay_requests.pop(message.get("id", None), None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    error_type = getattr(exceptions, message["error"], exceptions.NoonUnknownError)
+                    future.set_exception(error_type(message.get("message", None)))
+                else:
+                    future.set_result(message.get("result", None))
+        finally:
+            _LOGGER.debug("Relay connection closed")
+            self._relay_changes.put_nowait(None)
+            for future in self._relay_requests.values():
+                if not future.done():
+                    future.set_exception(NoonCommunicationError("Relay connection closed"))
+            self._relay_requests.clear()
+
+    async def _relay_request(self, op: str, **kwargs):
+        await self.authenticate()
+        request_id = next(self._relay_request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._relay_requests[request_id] = future
+        kwargs.update({"id": request_id, "op": op})
+        self._relay_writer.write(_encode(kwargs))
+        await self._relay_writer.drain()
+        return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+
+    async def _queryDevices(self) -> typing.Dict:
+        return await self._relay_request("snapshot")
+
+    async def _queryState(self) -> typing.Dict:
+        return await self._relay_request("snapshot")
+
+    async def _post_action(self, action: str, payload: typing.Dict, idempotent: bool=True):
+        await self._relay_request("action", action=action, payload=payload)
+
+    async def prewarm_connections(self):
+        pass
+
+    async def _internal_eventstream(self):
+        """Apply changes relayed from the upstream notification stream."""
+        try:
+            await self._relay_request("subscribe")
+            self._metrics.record_connect()
+            self._event_stream_connected = True
+            self._event_stream_error = None
+            if self._stream_ready is not None:
+                self._stream_ready.set()
+            while True:
+                message = await self._relay_changes.get()
+                if message is None:
+                    raise NoonProtocolError("Relay connection closed")
+                await self._handle_change(message["change"], message.get("tid", None))
+        except asyncio.CancelledError:
+            self._event_stream_error = "Canceled"
+        except Exception:
+            _LOGGER.exception("Relay event stream failed")
+            self._event_stream_error = "Unknown exception - {}".format(traceback.format_exc())
+        finally:
+            self._event_stream_connected = False
+            if self._stream_ready is not None:
+                self._stream_ready.clear()
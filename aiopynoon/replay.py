@@ -0,0 +1,194 @@
+""" Recording a Noon account, and playing recordings back without Noon. """
+
+import asyncio
+import json
+import logging
+import time
+import traceback
+import typing
+
+from .exceptions import NoonInvalidParametersError, NoonProtocolError
+from .line import ATTR_LINE_STATE, ATTR_DIM_LEVEL, LINE_STATE_ON, LINE_STATE_OFF
+from .noon import Noon
+from .space import ATTR_LIGHTS_ON, ATTR_ACTIVE_SCENE
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class NoonRecorder(object):
+    """Records an account's state and change notifications to a file for NoonReplay.
+
+    The file holds newline-delimited JSON: first {"discovery": {...}} in
+    discovery form, then {"at": seconds, "change": {...}, "tid": ...} for
+    each change, timed from the start of the recording.
+    """
+
+    @property
+    def recorded(self) -> int:
+        """Returns the number of changes recorded so far."""
+        return self._recorded
+
+    def __init__(self, noon: Noon, path: str):
+        self._noon = noon
+        self._path = path
+        self._file = None
+        self._started_at = None
+        self._recorded = 0
+
+    async def start(self):
+        """Write the current state, discovering it first if needed, then record changes."""
+        await self._noon.lines
+        self._file = open(self._path, "w")
+        self._started_at = time.monotonic()
+        self._write({"discovery": self._noon.to_json()})
+        self._noon.add_change_listener(self._handle_change)
+
+    def stop(self):
+        """Stop recording and close the file."""
+        if self._file is None:
+            return
+        self._noon.remove_change_listener(self._handle_change)
+        self._file.close()
+        self._file = None
+
+    def _handle_change(self, change: typing.Dict, tid: int):
+        self._write({"at": round(time.monotonic() - self._started_at, 6), "change": change, "tid": tid})
+        self._recorded = self._recorded + 1
+
+    def _write(self, message: typing.Dict):
+        self._file.write(json.dumps(message, separators=(",", ":")))
+        self._file.write("\n")
+
+
+class NoonReplay(Noon):
+    """A Noon that plays back a NoonRecorder file instead of connecting to Noon.
+
+    Discovery returns the recorded state, and the event stream replays the
+    recorded changes with their original timing (scaled by speed). Actions
+    are not sent anywhere; each is answered with the change notification
+    Noon would send, so commands are confirmed as they would be live.
+
+    Like Noon itself, the replay keeps the current state (returned by later
+    discovery queries) and only notifies changes while the stream is connected.
+    """
+
+    @property
+    def stream_backlog(self) -> int:
+        return self._replay_queue.qsize() if self._replay_queue is not None else 0
+
+    def __init__(self, path: str, speed: float=1.0, repeat: bool=False, **kwargs):
+        """Create a replay of the recording at path.
+
+        :param speed: Playback speed; 2 replays changes twice as fast as recorded
+        :param repeat: Start the recording again from the beginning when it ends
+
+        Extra keyword arguments are passed to Noon.
+        """
+        super().__init__(None, None, None, **kwargs)
+        self._replay_path = path
+        self._replay_speed = speed
+        self._replay_repeat = repeat
+        self._replay_discovery = None
+        self._replay_entities = {}
+        self._replay_changes = []
+        self._replay_queue = None
+
+    async def authenticate(self) -> bool:
+        """Load the recording if not already loaded."""
+        if self._replay_discovery is None:
+            with open(self._replay_path) as recording:
+                for line in recording:
+                    message = json.loads(line)
+                    if "discovery" in message:
+                        self._replay_discovery = message["discovery"]
+                    elif "change" in message:
+                        self._replay_changes.append(message)
+            if self._replay_discovery is None:
+                raise NoonProtocolError("Recording '{}' has no discovery".format(self._replay_path))
+            for space in self._replay_discovery.get("spaces", []):
+                self._replay_entities[space["guid"]] = space
+                for line in space.get("lines", None) or []:
+                    self._replay_entities[line["guid"]] = line
+            self._replay_queue = asyncio.Queue()
+        return True
+
+    async def _queryDevices(self) -> typing.Dict:
+        await self.authenticate()
+        return json.loads(json.dumps(self._replay_discovery))
+
+    async def _queryState(self) -> typing.Dict:
+        await self.authenticate()
+        return json.loads(json.dumps(self._replay_discovery))
+
+    async def prewarm_connections(self):
+        pass
+
+    async def _post_action(self, action: str, payload: typing.Dict, idempotent: bool=True):
+        """Answer an action with the changes Noon would notify."""
+        await self.authenticate()
+        changes = []
+        if action == "line/lightLevel":
+            level = payload["lightLevel"]
+            fields = [{"name": ATTR_LINE_STATE, "value": LINE_STATE_ON if level > 0 else LINE_STATE_OFF}]
+            if level > 0:
+                fields.append({"name": ATTR_DIM_LEVEL, "value": level})
+            changes.append({"guid": payload["line"], "fields": fields})
+        elif action == "space/scene":
+            changes.append({"guid": payload["space"], "fields": [
+                {"name": ATTR_ACTIVE_SCENE, "value": {"guid": payload["activeScene"]}},
+                {"name": ATTR_LIGHTS_ON, "value": payload["on"]}]})
+            if not payload["on"]:
+                for line in self.lines_in_space(payload["space"]):
+                    changes.append({"guid": line.guid, "fields": [{"name": ATTR_LINE_STATE, "value": LINE_STATE_OFF}]})
+        else:
+            raise NoonInvalidParametersError("Action '{}' cannot be replayed".format(action))
+        for change in changes:
+            self._replay_emit(change, payload.get("tid", None))
+
+    def _replay_emit(self, change: typing.Dict, tid: int=None):
+        """Apply a change to the replayed state, notifying it if the stream is connected."""
+        entity = self._replay_entities.get(change["guid"], None)
+        if entity is not None:
+            for field in change.get("fields", []):
+                entity[field["name"]] = field["value"]
+        if self._event_stream_connected:
+            self._replay_queue.put_nowait((change, tid))
+
+    async def _play(self):
+        """Feed the recorded changes into the event stream at their recorded times."""
+        while True:
+            started_at = time.monotonic()
+            for message in self._replay_changes:
+                delay = started_at + message["at"] / self._replay_speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._replay_emit(message["change"], message.get("tid", None))
+            """ A recording with no duration would repeat without ever yielding """
+            if not self._replay_repeat or len(self._replay_changes) == 0 or self._replay_changes[-1]["at"] <= 0:
+                return
+
+    async def _internal_eventstream(self):
+        """Apply replayed changes and the answers to actions."""
+        player = None
+        try:
+            await self.authenticate()
+            player = asyncio.ensure_future(self._play())
+            self._metrics.record_connect()
+            self._event_stream_connected = True
+            self._event_stream_error = None
+            if self._stream_ready is not None:
+                self._stream_ready.set()
+            while True:
+                change, tid = await self._replay_queue.get()
+                await self._handle_change(change, tid)
+        except asyncio.CancelledError:
+            self._event_stream_error = "Canceled"
+        except Exception:
+            _LOGGER.exception("Replay event stream failed")
+            self._event_stream_error = "Unknown exception - {}".format(traceback.format_exc())
+        finally:
+            if player is not None:
+                player.cancel()
+            self._event_stream_connected = False
+            if self._stream_ready is not None:
+                self._stream_ready.clear()
@@ -26,6 +26,10 @@ class NoonScene(NoonEntity):
         self._parent_space = parent_space
         super().__init__(noon, guid, name)
 
+    def to_json(self) -> Dict:
+        """Returns this scene in the same form as discovery."""
+        return {"guid": self._guid, "name": self._name}
+
     @classmethod
     async def from_json(cls, noon, space, json):
 
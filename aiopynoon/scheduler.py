@@ -0,0 +1,239 @@
+""" Scheduling scene and brightness changes. """
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+import typing
+import uuid
+
+from .const import Guid
+from .exceptions import NoonInvalidParametersError
+from .line import NoonLine
+from .space import NoonSpace
+
+_LOGGER = logging.getLogger(__name__)
+
+ACTION_BRIGHTNESS = "brightness"
+ACTION_SCENE = "scene"
+
+""" Actions due within this many seconds of each other are sent together """
+COALESCE_WINDOW = 0.5
+
+""" Seconds to wait before writing changes to the store """
+SAVE_DELAY = 1
+
+
+class NoonScheduledAction(object):
+    """A brightness or scene change to be made at a given time."""
+
+    def __init__(self, action_id: str, due: float, kind: str, target: Guid, params: typing.Dict):
+        self.action_id = action_id
+        self.due = due
+        self.kind = kind
+        self.target = target
+        self.params = params
+
+    def to_json(self) -> typing.Dict:
+        return {"id": self.action_id, "due": self.due, "kind": self.kind, "target": self.target, "params": self.params}
+
+    @classmethod
+    def from_json(cls, json: typing.Dict):
+        return cls(json["id"], json["due"], json["kind"], json["target"], json["params"])
+
+    def __repr__(self):
+        """Returns a stringified representation of this object."""
+        return str(self.to_json())
+
+
+class NoonScheduler(object):
+    """Runs scheduled actions for a Noon account from a single task.
+
+    Pending actions are kept in one heap; cancelling marks the heap entry as
+    removed, and rescheduling pushes a new entry, so both are O(log n).
+    Actions that fall due together are combined and sent through the
+    planner. If store_path is given, pending actions are saved there and
+    reloaded by start().
+    """
+
+    @property
+    def pending(self) -> typing.List[NoonScheduledAction]:
+        """Returns the pending actions, soonest first."""
+        return sorted((entry[2] for entry in self._entries.values()), key=lambda action: action.due)
+
+    def __init__(self, noon, store_path: str=None, coalesce_window: float=COALESCE_WINDOW):
+        """Create a scheduler.
+
+        :param noon: The Noon account to act on
+        :param store_path: JSON file in which to persist pending actions
+        :param coalesce_window: Seconds within which due actions are batched together
+        """
+        self._noon = noon
+        self._store_path = store_path
+        self._coalesce_window = coalesce_window
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._save_handle = None
+
+    def schedule_brightness(self, line_id: Guid, brightness_level: int, at: float, transition_time: int=None) -> str:
+        """Schedule a line brightness change at a wall-clock time, returning the action ID."""
+        return self._add(NoonScheduledAction(uuid.uuid4().hex, at, ACTION_BRIGHTNESS, line_id,
+            {"brightnessLevel": brightness_level, "transitionTime": transition_time}))
+
+    def schedule_scene(self, space_id: Guid, at: float, active: bool=None, scene_id: Guid=None, scene_name: str=None) -> str:
+        """Schedule a space scene change at a wall-clock time, returning the action ID."""
+        return self._add(NoonScheduledAction(uuid.uuid4().hex, at, ACTION_SCENE, space_id,
+            {"active": active, "sceneId": scene_id, "sceneName": scene_name}))
+
+    def cancel(self, action_id: str) -> bool:
+        """Cancel a pending action. Returns False if it was not pending."""
+        entry = self._entries.pop(action_id, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self._save_soon()
+        return True
+
+    def reschedule(self, action_id: str, at: float) -> bool:
+        """Move a pending action to a new time. Returns False if it was not pending."""
+        entry = self._entries.pop(action_id, None)
+        if entry is None:
+            return False
+        action = entry[2]
+        entry[2] = None
+        action.due = at
+        self._add(action)
+        return True
+
+    async def start(self):
+        """Load any persisted actions and start running them."""
+        assert self._task is None, "Scheduler already started"
+        self._wakeup = asyncio.Event()
+        if self._store_path is not None and os.path.exists(self._store_path):
+            with open(self._store_path) as store:
+                for action in json.load(store):
+                    self._add(NoonScheduledAction.from_json(action), save=False)
+            _LOGGER.debug("Loaded {} scheduled actions".format(len(self._entries)))
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop running actions, saving those still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        self._save()
+
+    def _add(self, action: NoonScheduledAction, save: bool=True) -> str:
+        entry = [action.due, next(self._sequence), action]
+        self._entries[action.action_id] = entry
+        heapq.heappush(self._heap, entry)
+        if self._wakeup is not None and self._heap[0] is entry:
+            self._wakeup.set()
+        if save:
+            self._save_soon()
+        return action.action_id
+
+    def _peek(self) -> typing.List:
+        """Returns the earliest live heap entry, discarding cancelled ones."""
+        while len(self._heap) > 0 and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0] if len(self._heap) > 0 else None
+
+    async def _run(self):
+        """Sleep until the next action is due, then run every action due with it."""
+        while True:
+            entry = self._peek()
+            delay = None if entry is None else entry[0] - time.time()
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = []
+            cutoff = time.time() + self._coalesce_window
+            while entry is not None and entry[0] <= cutoff:
+                heapq.heappop(self._heap)
+                del self._entries[entry[2].action_id]
+                batch.append(entry[2])
+                entry = self._peek()
+            self._save_soon()
+            try:
+                await self._run_batch(batch)
+            except Exception:
+                _LOGGER.exception("Failed to run {} scheduled actions".format(len(batch)))
+
+    async def _run_batch(self, batch: typing.List[NoonScheduledAction]):
+        """Combine a batch of due actions into as few commands as possible."""
+        lines_by_transition = {}
+        spaces = {}
+        others = []
+        for action in batch:
+            params = action.params
+            """ A stale target (e.g. a line removed since the action was saved) must not hold up the rest of the batch """
+            expected_type = NoonLine if action.kind == ACTION_BRIGHTNESS else NoonSpace
+            if not isinstance(self._noon.get_entity(action.target), expected_type):
+                _LOGGER.warning("Dropping scheduled {} action for unknown {} '{}'".format(action.kind,
+                    expected_type.__name__, action.target))
+                continue
+            if action.kind == ACTION_BRIGHTNESS:
+                lines_by_transition.setdefault(params["transitionTime"], {})[action.target] = params["brightnessLevel"]
+            elif action.kind == ACTION_SCENE and params["sceneId"] is None and params["sceneName"] is None \
+                    and params["active"] is not None:
+                spaces[action.target] = params["active"]
+            else:
+                others.append(action)
+
+        """ Spaces are planned with the first group of lines, so 'all off' can still collapse """
+        plans = [(lines, spaces if index == 0 else None, transition_time)
+            for index, (transition_time, lines) in enumerate(lines_by_transition.items())]
+        if len(plans) == 0 and len(spaces) > 0:
+            plans.append((None, spaces, None))
+
+        _LOGGER.debug("Running {} scheduled actions".format(len(batch)))
+        await asyncio.gather(*[self._noon.set_states(lines, spaces, transition_time) for lines, spaces, transition_time in plans],
+            *[self._run_action(action) for action in others])
+
+    async def _run_action(self, action: NoonScheduledAction):
+        entity = self._noon.get_entity(action.target)
+        params = action.params
+        if action.kind == ACTION_BRIGHTNESS and isinstance(entity, NoonLine):
+            await entity.set_brightness(params["brightnessLevel"], params["transitionTime"])
+        elif action.kind == ACTION_SCENE and isinstance(entity, NoonSpace):
+            await entity.set_scene(params["active"], params["sceneId"], params["sceneName"])
+        else:
+            raise NoonInvalidParametersError("Cannot run {} action on '{}'".format(action.kind, action.target))
+
+    def _save_soon(self):
+        """Write the store shortly, so bursts of changes cost one write."""
+        if self._store_path is None or self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._save_handle = loop.call_later(SAVE_DELAY, self._save)
+
+    def _save(self):
+        self._save_handle = None
+        if self._store_path is None:
+            return
+        temporary_path = "{}.tmp".format(self._store_path)
+        with open(temporary_path, "w") as store:
+            json.dump([action.to_json() for action in self.pending], store)
+        os.replace(temporary_path, self._store_path)
@@ -0,0 +1,319 @@
+""" Spreading Noon accounts across worker processes. """
+
+import asyncio
+import bisect
+import concurrent.futures
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import typing
+
+from . import exceptions
+from .const import Guid
+from .exceptions import NoonCommunicationError, NoonInvalidParametersError
+
+_LOGGER = logging.getLogger(__name__)
+
+""" Virtual nodes per worker on the hash ring """
+RING_REPLICAS = 100
+
+""" Most events sent to the parent in one message """
+EVENT_BATCH_SIZE = 500
+
+""" Seconds between checks that the workers are alive """
+SUPERVISE_INTERVAL = 1
+
+""" Entity methods that can be called through the runner """
+SHARD_COMMANDS = ("set_brightness", "turn_on", "turn_off", "set_scene", "activate_scene", "deactivate_scene")
+
+
+class NoonHashRing(object):
+    """Consistent hash ring mapping keys (account IDs) to nodes (workers)."""
+
+    def __init__(self, nodes: typing.Iterable[int], replicas: int=RING_REPLICAS):
+        """Build the ring."""
+        self._ring = []
+        for node in nodes:
+            for replica in range(replicas):
+                self._ring.append((self._hash("{}:{}".format(node, replica)), node))
+        self._ring.sort()
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def node_for(self, key: str) -> int:
+        """Returns the node that owns key."""
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[index][1]
+
+
+class NoonShardEvent(object):
+    """An entity event from an account running in a worker process."""
+
+    def __init__(self, account_id: str, entity_guid: Guid, entity_type: str, event: int, params: typing.Dict):
+        self.account_id = account_id
+        self.entity_guid = entity_guid
+        self.entity_type = entity_type
+        self.event = event
+        self.params = params
+
+    def __repr__(self):
+        """Returns a stringified representation of this object."""
+        return str({'account': self.account_id, 'entity': self.entity_guid, 'type': self.entity_type,
+                    'event': self.event, 'params': self.params})
+
+
+def _worker_main(shard: int, conn, accounts: typing.Dict, manager_kwargs: typing.Dict):
+    """Entry point for a worker process."""
+    try:
+        asyncio.run(_worker_loop(shard, conn, accounts, manager_kwargs))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker_loop(shard: int, conn, accounts: typing.Dict, manager_kwargs: typing.Dict):
+    """Run a NoonManager for this worker's accounts, serving commands from the parent."""
+    from .manager import NoonManager
+
+    loop = asyncio.get_running_loop()
+    manager = NoonManager(**manager_kwargs)
+    for account_id, (username, password, kwargs) in accounts.items():
+        manager.add_account(account_id, username, password, **kwargs)
+    await manager.start()
+
+    """ All sends go through one thread, so messages are never interleaved """
+    sender = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    send = lambda message: loop.run_in_executor(sender, conn.send, message)
+
+    async def forward_events():
+        queue = manager._events
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < EVENT_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            await send(("events", [(e.account_id, e.entity.guid, type(e.entity).__name__, e.event, e.params) for e in batch]))
+
+    async def run_command(request_id, message):
+        try:
+            result = await _worker_command(manager, message)
+            await send(("result", request_id, True, result))
+        except Exception as e:
+            """ Exceptions may not unpickle in the parent, so send the class name and rebuild it there """
+            await send(("result", request_id, False, (type(e).__name__, str(e))))
+
+    forwarder = loop.create_task(forward_events())
+    try:
+        while True:
+            message = await loop.run_in_executor(None, conn.recv)
+            if message[0] == "stop":
+                break
+            loop.create_task(run_command(message[1], message))
+    except EOFError:
+        _LOGGER.debug("Shard {} lost its parent".format(shard))
+    finally:
+        forwarder.cancel()
+        await manager.stop()
+        sender.shutdown(wait=False)
+
+
+async def _worker_command(manager, message):
+    """Carry out a request from the parent."""
+    kind = message[0]
+    if kind == "add_account":
+        _, _, account_id, username, password, kwargs = message
+        manager.add_account(account_id, username, password, **kwargs)
+        return None
+    elif kind == "remove_account":
+        await manager.remove_account(message[2])
+        return None
+    elif kind == "health":
+        return manager.health()
+    elif kind == "command":
+        _, _, account_id, entity_guid, method, args, kwargs = message
+        account = manager.accounts.get(account_id, None)
+        if account is None:
+            raise NoonInvalidParametersError("Unknown account '{}'".format(account_id))
+        entity = account.noon.get_entity(entity_guid)
+        if entity is None or method not in SHARD_COMMANDS or not hasattr(entity, method):
+            raise NoonInvalidParametersError("Cannot call {} on '{}'".format(method, entity_guid))
+        command = await getattr(entity, method)(*args, **kwargs)
+        return command.tid
+    raise NoonInvalidParametersError("Unknown request '{}'".format(kind))
+
+
+class _Shard(object):
+    """Parent-side handle on a worker process."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.accounts = {}
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+
+
+class NoonShardedRunner(object):
+    """Runs accounts in worker processes, chosen by consistent hashing of the account ID.
+
+    Each worker runs a NoonManager. The parent restarts crashed workers,
+    routes commands to the worker that owns the account, and merges the
+    workers' events into one feed. A request that fails in a worker raises
+    the same NoonException subclass in the parent (NoonUnknownError for
+    anything else).
+    """
+
+    @property
+    def workers(self) -> int:
+        return len(self._shards)
+
+    def __init__(self, workers: int=None, max_queued_events: int=100000, **manager_kwargs):
+        """Create a runner.
+
+        :param workers: Number of worker processes (defaults to the CPU count)
+        :param max_queued_events: Size of the merged event feed
+        :param manager_kwargs: Passed to NoonManager in each worker
+        """
+        workers = workers or os.cpu_count() or 1
+        self._shards = [_Shard(index) for index in range(workers)]
+        self._ring = NoonHashRing(range(workers))
+        self._manager_kwargs = manager_kwargs
+        self._context = multiprocessing.get_context("spawn")
+        self._request_ids = itertools.count()
+        self._requests = {}
+        self._max_queued_events = max_queued_events
+        self._events = None
+        self._dropped_events = 0
+        self._loop = None
+        self._supervisor = None
+
+    def shard_for(self, account_id: str) -> int:
+        """Returns the index of the worker that runs account_id."""
+        return self._ring.node_for(account_id)
+
+    async def add_account(self, account_id: str, username: str, password: str, **kwargs):
+        """Add an account to the worker that owns it. Extra keyword arguments are passed to Noon."""
+        shard = self._shards[self.shard_for(account_id)]
+        shard.accounts[account_id] = (username, password, kwargs)
+        if shard.process is not None:
+            await self._request(shard, "add_account", account_id, username, password, kwargs)
+
+    async def remove_account(self, account_id: str):
+        shard = self._shards[self.shard_for(account_id)]
+        del shard.accounts[account_id]
+        if shard.process is not None:
+            await self._request(shard, "remove_account", account_id)
+
+    async def start(self):
+        """Start the worker processes."""
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue(maxsize=self._max_queued_events)
+        for shard in self._shards:
+            self._start_shard(shard)
+        self._supervisor = self._loop.create_task(self._supervise())
+
+    async def stop(self):
+        """Stop the worker processes."""
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        for shard in self._shards:
+            if shard.process is None:
+                continue
+            try:
+                shard.conn.send(("stop",))
+            except (OSError, EOFError):
+                pass
+            await self._loop.run_in_executor(None, shard.process.join, 10)
+            if shard.process.is_alive():
+                shard.process.terminate()
+            shard.conn.close()
+            shard.process = None
+
+    async def command(self, account_id: str, entity_guid: Guid, method: str, *args, **kwargs) -> int:
+        """Call a command (e.g. 'set_brightness') on an entity, returning the command's tid."""
+        if method not in SHARD_COMMANDS:
+            raise NoonInvalidParametersError("Unsupported command '{}'".format(method))
+        shard = self._shards[self.shard_for(account_id)]
+        return await self._request(shard, "command", account_id, entity_guid, method, args, kwargs)
+
+    async def health(self) -> typing.Dict[str, typing.Dict]:
+        """Returns the health of every account, keyed by account ID."""
+        result = {}
+        for shard_health in await asyncio.gather(*[self._request(shard, "health") for shard in self._shards]):
+            result.update(shard_health)
+        return result
+
+    async def events(self) -> typing.AsyncIterator[NoonShardEvent]:
+        """Yields events from every worker as they arrive."""
+        while True:
+            yield await self._events.get()
+
+    def _start_shard(self, shard: _Shard):
+        parent_conn, child_conn = self._context.Pipe()
+        shard.conn = parent_conn
+        shard.process = self._context.Process(target=_worker_main, name="noon-shard-{}".format(shard.index),
+            args=(shard.index, child_conn, dict(shard.accounts), self._manager_kwargs), daemon=True)
+        shard.process.start()
+        child_conn.close()
+        threading.Thread(target=self._read_shard, args=(shard, parent_conn), daemon=True).start()
+
+    def _read_shard(self, shard: _Shard, conn):
+        """Read messages from a worker (runs in its own thread)."""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            self._loop.call_soon_threadsafe(self._handle_message, shard, message)
+
+    def _handle_message(self, shard: _Shard, message):
+        if message[0] == "events":
+            for account_id, entity_guid, entity_type, event, params in message[1]:
+                try:
+                    self._events.put_nowait(NoonShardEvent(account_id, entity_guid, entity_type, event, params))
+                except asyncio.QueueFull:
+                    self._dropped_events = self._dropped_events + 1
+        elif message[0] == "result":
+            _, request_id, ok, payload = message
+            future = self._requests.pop(request_id, (None, None))[1]
+            if future is None or future.done():
+                return
+            if ok:
+                future.set_result(payload)
+            else:
+                error, error_message = payload
+                error_type = getattr(exceptions, error, exceptions.NoonUnknownError)
+                future.set_exception(error_type(error_message))
+
+    async def _request(self, shard: _Shard, kind: str, *args):
+        request_id = next(self._request_ids)
+        future = self._loop.create_future()
+        self._requests[request_id] = (shard.index, future)
+        try:
+            shard.conn.send((kind, request_id) + args)
+        except (OSError, EOFError) as e:
+            self._requests.pop(request_id, None)
+            raise NoonCommunicationError("Shard {} is unavailable".format(shard.index)) from e
+        return await future
+
+    async def _supervise(self):
+        """Restart any worker that has exited."""
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for shard in self._shards:
+                if shard.process is None or shard.process.is_alive():
+                    continue
+                _LOGGER.error("Shard {} exited with code {}, restarting".format(shard.index, shard.process.exitcode))
+                shard.restarts = shard.restarts + 1
+                shard.conn.close()
+                for request_id, (index, future) in list(self._requests.items()):
+                    if index == shard.index:
+                        del self._requests[request_id]
+                        if not future.done():
+                            future.set_exception(NoonCommunicationError("Shard {} exited".format(shard.index)))
+                self._start_shard(shard)
@@ -0,0 +1,137 @@
+""" Columnar, array-backed view of line state. """
+
+import logging
+import typing
+from array import array
+
+from .const import Guid
+from .line import LINE_STATE_ON, LINE_STATE_OFF
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_LOGGER = logging.getLogger(__name__)
+
+""" Stored for on/off or dimming level when the value is unknown """
+UNKNOWN = -1
+
+
+class NoonLineTable(object):
+    """Parallel arrays describing every line on an account.
+
+    Row i of each array describes the line guids[i]. The arrays are updated
+    in place as events arrive, and can be exported without copying with
+    buffers() or as_numpy(). A new table is built on each discovery, so
+    exported buffers stay valid (but stop updating) after a refresh.
+    """
+
+    @property
+    def guids(self) -> typing.List[Guid]:
+        """Returns the line GUID for each row."""
+        return self._guids
+
+    @property
+    def space_guids(self) -> typing.List[Guid]:
+        """Returns the space GUID for each space index."""
+        return self._space_guids
+
+    @property
+    def space_index(self) -> array:
+        """Returns the index (into space_guids) of each line's space."""
+        return self._space_index
+
+    @property
+    def line_on(self) -> array:
+        """Returns 1 for lines that are on, 0 for off, and -1 if unknown."""
+        return self._line_on
+
+    @property
+    def dimming_level(self) -> array:
+        """Returns each line's dimming level, or -1 if unknown."""
+        return self._dimming_level
+
+    def __init__(self):
+        """Initializes an empty table."""
+        self._guids = []
+        self._rows = {}
+        self._space_guids = []
+        self._space_rows = {}
+        self._space_index = array('i')
+        self._line_on = array('b')
+        self._dimming_level = array('h')
+
+    def __len__(self):
+        return len(self._guids)
+
+    def row(self, guid: Guid) -> int:
+        """Returns the row for a line, or None."""
+        return self._rows.get(guid, None)
+
+    def add_line(self, guid: Guid, space_guid: Guid, line_state: str, dimming_level: int):
+        """Append a line to the table."""
+        if guid in self._rows:
+            return
+        space = self._space_rows.get(space_guid, None)
+        if space is None:
+            space = len(self._space_guids)
+            self._space_guids.append(space_guid)
+            self._space_rows[space_guid] = space
+        self._rows[guid] = len(self._guids)
+        self._guids.append(guid)
+        self._space_index.append(space)
+        self._line_on.append(self._encode_line_state(line_state))
+        self._dimming_level.append(UNKNOWN if dimming_level is None else dimming_level)
+
+    def set_line_state(self, guid: Guid, line_state: str):
+        row = self._rows.get(guid, None)
+        if row is not None:
+            self._line_on[row] = self._encode_line_state(line_state)
+
+    def set_dimming_level(self, guid: Guid, dimming_level: int):
+        row = self._rows.get(guid, None)
+        if row is not None:
+            self._dimming_level[row] = UNKNOWN if dimming_level is None else dimming_level
+
+    @staticmethod
+    def _encode_line_state(line_state: str) -> int:
+        if line_state == LINE_STATE_ON:
+            return 1
+        elif line_state == LINE_STATE_OFF:
+            return 0
+        return UNKNOWN
+
+    def buffers(self) -> typing.Dict[str, memoryview]:
+        """Returns read-only, zero-copy views of the state arrays."""
+        return {
+            "spaceIndex": memoryview(self._space_index).toreadonly(),
+            "lineOn": memoryview(self._line_on).toreadonly(),
+            "dimmingLevel": memoryview(self._dimming_level).toreadonly(),
+        }
+
+    def as_numpy(self) -> typing.Dict[str, typing.Any]:
+        """Returns zero-copy NumPy views of the state arrays. Requires NumPy."""
+        if numpy is None:
+            raise ImportError("NumPy is required for as_numpy()")
+        return {name: numpy.frombuffer(view, dtype=view.format) for name, view in self.buffers().items()}
+
+    def percent_on_by_space(self) -> typing.Dict[Guid, float]:
+        """Returns the percentage of lines (with known state) that are on, per space."""
+        if len(self._guids) == 0:
+            return {}
+        if numpy is not None:
+            columns = self.as_numpy()
+            known = columns["lineOn"] >= 0
+            spaces = columns["spaceIndex"][known]
+            totals = numpy.bincount(spaces, minlength=len(self._space_guids))
+            on = numpy.bincount(spaces, weights=columns["lineOn"][known], minlength=len(self._space_guids))
+            return {guid: float(100.0 * on[i] / totals[i]) for i, guid in enumerate(self._space_guids) if totals[i] > 0}
+
+        totals = [0] * len(self._space_guids)
+        on = [0] * len(self._space_guids)
+        for space, line_on in zip(self._space_index, self._line_on):
+            if line_on >= 0:
+                totals[space] = totals[space] + 1
+                on[space] = on[space] + line_on
+        return {guid: float(100.0 * on[i] / totals[i]) for i, guid in enumerate(self._space_guids) if totals[i] > 0}
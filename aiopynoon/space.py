@@ -4,6 +4,7 @@ import asyncio
 import logging
 import typing
 from .entity import NoonEntity
+from .command import NoonCommand
 from .const import Guid
 from .event import NoonEvent
 from .exceptions import NoonInvalidParametersError, NoonInvalidJsonError
@@ -35,6 +36,20 @@ class NoonSpace(NoonEntity):
         """
         LIGHTSON_CHANGED = 2
 
+        """
+        CHANGE_CONFIRMED: An optimistic change was confirmed by Noon.
+            Params:
+            field name: Confirmed value
+        """
+        CHANGE_CONFIRMED = 3
+
+        """
+        CHANGE_REVERTED: An optimistic change was not applied by Noon.
+            Params:
+            field name: Actual value
+        """
+        CHANGE_REVERTED = 4
+
     @property
     def lights_on(self) -> bool:
         return self._lights_on
@@ -42,8 +57,10 @@ class NoonSpace(NoonEntity):
     async def set_lights_on(self, new_value: bool):
         assert isinstance(new_value, bool), 'Argument of wrong type!'
         value_changed = (self._lights_on != new_value)
+        old_value = self._lights_on
         self._lights_on = new_value
         if value_changed:
+            self._noon._entity_field_changed(self, ATTR_LIGHTS_ON, old_value, new_value)
             await self._dispatch_event(NoonSpace.Event.LIGHTSON_CHANGED, {ATTR_LIGHTS_ON: self._lights_on})
 
     @property
@@ -57,23 +74,22 @@ class NoonSpace(NoonEntity):
     async def set_active_scene_id(self, new_value: Guid):
         assert isinstance(new_value, Guid), 'Argument of wrong type!'
         value_changed = (self._active_scene_id != new_value)
+        old_value = self._active_scene_id
         self._active_scene_id = new_value
         if value_changed:
+            self._noon._entity_field_changed(self, ATTR_ACTIVE_SCENE, old_value, new_value)
             await self._dispatch_event(NoonSpace.Event.SCENE_CHANGED, {ATTR_ACTIVE_SCENE: self._active_scene_id})
 
-    async def activate_scene(self):
-        await self.set_scene(active=True)
+    async def activate_scene(self) -> NoonCommand:
+        return await self.set_scene(active=True)
 
-    async def deactivate_scene(self):
-        await self.set_scene(active=False)
+    async def deactivate_scene(self) -> NoonCommand:
+        return await self.set_scene(active=False)
 
-    async def set_scene(self, active:bool=None, scene_id:Guid=None, scene_name:str=None):
+    async def set_scene(self, active:bool=None, scene_id:Guid=None, scene_name:str=None) -> NoonCommand:
 
         _LOGGER.debug("Set scene to {}".format(scene_id))
 
-        """ (Re)authenticate if needed """
-        await self._noon.authenticate()
-
         """ Replace variables """
         if active is None:
             active = self.lights_on
@@ -87,9 +103,7 @@ class NoonSpace(NoonEntity):
         if scene_id is not None:
             target_scene_id = scene_id
         elif scene_name is not None:
-            for (this_scene_id, this_scene) in self._scenes.items():
-                if this_scene.name == scene_name:
-                    target_scene_id = this_scene_id
+            target_scene_id = self._scenes_by_name.get(scene_name, None)
             if target_scene_id is None:
                 raise NoonInvalidParametersError("Scene '{}' not found".format(scene_name))
         
@@ -99,15 +113,25 @@ class NoonSpace(NoonEntity):
         except KeyError:
             raise NoonInvalidParametersError("Scene id '{}' not found".format(target_scene_id))
 
+        """ Work out which fields should change, from the state Noon last reported """
+        expected = {}
+        if target_scene.guid != self._reported_value(ATTR_ACTIVE_SCENE, self._active_scene_id):
+            expected[ATTR_ACTIVE_SCENE] = target_scene.guid
+        if active != self._reported_value(ATTR_LIGHTS_ON, self._lights_on):
+            expected[ATTR_LIGHTS_ON] = active
+
         """ Send the command """
         _LOGGER.debug("Attempting to activate scene {} in space '{}', with active = {}".format(target_scene.name, self.name, active))
-        actionUrl = "{}/api/action/space/scene".format(self._noon._endpoints["action"])
-        async with self._noon.session.post(actionUrl, 
-            headers={"Authorization": "Token {}".format(self._noon._token)}, 
-            json={"space": self.guid, "activeScene": target_scene.guid, "on": active, "tid": 55555}, 
-            raise_for_status=True) as raw_response:
+        command = await self._noon._send_command(self, "space/scene",
+            {"space": self.guid, "activeScene": target_scene.guid, "on": active},
+            expected)
+
+        """ Apply locally if optimistic """
+        if self._noon.optimistic:
+            await self._set_optimistic(ATTR_ACTIVE_SCENE, target_scene.guid, self._active_scene_id, self.set_active_scene_id)
+            await self._set_optimistic(ATTR_LIGHTS_ON, active, self._lights_on, self.set_lights_on)
 
-            _LOGGER.debug("Got set_scene result {}: {}".format(raw_response.status, raw_response))
+        return command
 
     def __init__(self, noon, guid, name, active_scene_id:Guid=None, lights_on:bool=None, lines:Dict={}, scenes:Dict={}):
         """Initialize the space."""
@@ -115,6 +139,7 @@ class NoonSpace(NoonEntity):
         self._lights_on = None
         self._lines = None
         self._scenes = None
+        self._scenes_by_name = {}
         self._active_scene_id = active_scene_id
         self._lights_on = lights_on
         super().__init__(noon, guid, name)
@@ -131,14 +156,25 @@ class NoonSpace(NoonEntity):
                     new_value = False
                 else:
                     raise NoonInvalidParametersError("Invalid lightsOn value '{}'".format(changed_field["value"]))
-                await self.set_lights_on(new_value)
+                await self._update_field(ATTR_LIGHTS_ON, new_value, self.set_lights_on)
             elif changed_field["name"] == ATTR_ACTIVE_SCENE:
-                await self.set_active_scene_id(changed_field["value"]["guid"])
+                await self._update_field(ATTR_ACTIVE_SCENE, changed_field["value"]["guid"], self.set_active_scene_id)
             elif changed_field["name"] == ATTR_LIGHTING_CONFIG_MODIFIED:
                 pass
             else:
                 _LOGGER.warn("Unhandled change to field '{}'".format(changed_field["name"]))
 
+    def to_json(self) -> Dict:
+        """Returns this space, with its lines and scenes, in the same form as discovery."""
+        return {
+            "guid": self.guid,
+            "name": self.name,
+            "lightsOn": self._lights_on,
+            "activeScene": {"guid": self._active_scene_id},
+            "lines": [line.to_json() for line in (self._lines or {}).values()],
+            "scenes": [scene.to_json() for scene in (self._scenes or {}).values()],
+        }
+
     @classmethod
     async def from_json(cls, noon, json):
         """Initialize a Noon Space from JSON"""
@@ -159,10 +195,13 @@ class NoonSpace(NoonEntity):
 
         """Scenes"""
         scenes_map = {}
+        scenes_by_name = {}
         for scene in json.get("scenes", []):
             this_scene = await NoonScene.from_json(noon, new_space, scene)
             scenes_map[this_scene.guid] = this_scene
+            scenes_by_name[this_scene.name] = this_scene.guid
         new_space._scenes = scenes_map
+        new_space._scenes_by_name = scenes_by_name
 
         """Lines"""
         lines_map = {}
@@ -0,0 +1,179 @@
+""" Batched persistence of Noon events to SQLite. """
+
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import typing
+
+from .entity import NoonEntity
+
+_LOGGER = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class NoonSQLiteSink(object):
+    """Writes entity events to a SQLite database from a background thread.
+
+    Events are queued without blocking the event stream and written in
+    batches, in WAL mode. If the queue is full (for example, because the
+    disk is slow) new events are dropped and counted rather than delaying
+    the notification stream.
+    """
+
+    @property
+    def dropped(self) -> int:
+        """Returns the number of events dropped because the queue was full."""
+        return self._dropped
+
+    @property
+    def written(self) -> int:
+        """Returns the number of events written to the database."""
+        return self._written
+
+    @property
+    def flushes(self) -> int:
+        """Returns the number of batches written."""
+        return self._flushes
+
+    @property
+    def last_flush_latency(self) -> float:
+        """Returns the seconds taken by the last batch write, or None."""
+        return self._last_flush_latency
+
+    @property
+    def max_flush_latency(self) -> float:
+        """Returns the longest batch write, in seconds, or None."""
+        return self._max_flush_latency
+
+    @property
+    def queue_depth(self) -> int:
+        """Returns the number of events waiting to be written."""
+        return self._queue.qsize()
+
+    def __init__(self, path: str, batch_size: int=500, flush_interval: float=1.0, max_queued: int=10000,
+            table: str="noon_events"):
+        """Create a sink.
+
+        :param path: SQLite database file
+        :param batch_size: Most events written in one transaction
+        :param flush_interval: Most seconds an event waits before being written
+        :param max_queued: Events held in memory before new events are dropped
+        :param table: Table to write events to
+        """
+        self._path = path
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._table = table
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = None
+        self._dropped = 0
+        self._written = 0
+        self._flushes = 0
+        self._last_flush_latency = None
+        self._max_flush_latency = None
+
+    def attach(self, noon, account_id: str=None):
+        """Record events from every entity on a Noon account."""
+        noon.subscribe(self._handle_event, account_id)
+
+    def detach(self, noon, account_id: str=None):
+        noon.unsubscribe(self._handle_event, account_id)
+
+    def start(self):
+        """Start the writer thread."""
+        assert self._thread is None, "Sink already started"
+        self._thread = threading.Thread(target=self._run, name="noon-sqlite-sink", daemon=True)
+        self._thread.start()
+
+    async def stop(self, timeout: float=None):
+        """Write any queued events and stop the writer thread.
+
+        Waits in an executor, so the event loop keeps running while the queue drains.
+
+        :param timeout: Most seconds to wait, or None to wait until every queued event is written
+        """
+        if self._thread is None:
+            return
+        thread = self._thread
+        self._thread = None
+        await asyncio.get_running_loop().run_in_executor(None, self._join, thread, timeout)
+
+    def _join(self, thread: threading.Thread, timeout: float):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            _LOGGER.warning("SQLite sink did not drain its queue in time")
+            return
+        thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+    def counters(self) -> typing.Dict:
+        """Returns the sink's counters as a dictionary."""
+        return {
+            "queued": self.queue_depth,
+            "dropped": self._dropped,
+            "written": self._written,
+            "flushes": self._flushes,
+            "lastFlushLatency": self._last_flush_latency,
+            "maxFlushLatency": self._max_flush_latency,
+        }
+
+    async def _handle_event(self, entity: NoonEntity, account_id: str, event, params: typing.Dict):
+        """Queue an event for writing, dropping it if the queue is full."""
+        try:
+            self._queue.put_nowait((time.time(), account_id, entity.guid, type(entity).__name__, event, json.dumps(params)))
+        except queue.Full:
+            self._dropped = self._dropped + 1
+
+    def _run(self):
+        """Writer thread: batch events from the queue into the database."""
+        connection = sqlite3.connect(self._path)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS {} (timestamp REAL, account TEXT, guid TEXT, "
+                "entity_type TEXT, event INTEGER, params TEXT)".format(self._table))
+            connection.commit()
+            insert = "INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?)".format(self._table)
+
+            stopping = False
+            while not stopping:
+                batch = []
+                deadline = None
+                while len(batch) < self._batch_size:
+                    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                    try:
+                        item = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self._flush_interval
+                if len(batch) > 0:
+                    self._flush(connection, insert, batch)
+        finally:
+            connection.close()
+
+    def _flush(self, connection, insert: str, batch: typing.List):
+        started = time.monotonic()
+        try:
+            with connection:
+                connection.executemany(insert, batch)
+        except sqlite3.Error:
+            _LOGGER.exception("Failed to write {} events".format(len(batch)))
+            self._dropped = self._dropped + len(batch)
+            return
+        latency = time.monotonic() - started
+        self._written = self._written + len(batch)
+        self._flushes = self._flushes + 1
+        self._last_flush_latency = latency
+        if self._max_flush_latency is None or latency > self._max_flush_latency:
+            self._max_flush_latency = latency
@@ -0,0 +1,202 @@
+""" Blocking, thread-safe access to Noon for non-async code. """
+
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import typing
+
+from .command import NoonCommand
+from .const import Guid
+from .entity import NoonEntity
+from .exceptions import NoonInvalidParametersError
+from .line import NoonLine
+from .noon import Noon
+from .space import NoonSpace
+from .transport import create_session
+
+_LOGGER = logging.getLogger(__name__)
+
+NoonSyncEventHandler = typing.Callable[[Guid, typing.Any, typing.Dict], None]
+
+
+class NoonSync(object):
+    """Runs a Noon account on a dedicated event loop thread.
+
+    Every method may be called from any thread. Commands are available as
+    blocking calls and as *_future variants returning concurrent.futures
+    Futures. All callers share the one session, token and event stream.
+    """
+
+    @property
+    def noon(self) -> Noon:
+        """Returns the underlying Noon object. Only use it from the loop thread."""
+        return self._noon
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def __init__(self, username: str=None, password: str=None, start_timeout: float=60,
+            noon_factory: typing.Callable[[], Noon]=None, **kwargs):
+        """Start the loop thread, log in, discover and connect the event stream.
+
+        :param noon_factory: Called on the loop thread to create the Noon
+            object (e.g. a NoonReplay or NoonRelayClient) instead of logging
+            in with username and password
+
+        Extra keyword arguments are passed to Noon.
+        """
+        self._handlers = []
+        self._handlers_lock = threading.Lock()
+        self._session = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="noon-loop", daemon=True)
+        self._thread.start()
+        try:
+            self._noon = self._call(self._start(username, password, noon_factory, kwargs), start_timeout)
+        except BaseException:
+            self.close()
+            raise
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def _start(self, username: str, password: str, noon_factory, kwargs: typing.Dict) -> Noon:
+        if noon_factory is not None:
+            noon = noon_factory()
+        else:
+            self._session = create_session()
+            noon = Noon(self._session, username, password, **kwargs)
+        noon.subscribe(self._handle_event, None)
+        await noon.start()
+        return noon
+
+    def submit(self, coroutine) -> concurrent.futures.Future:
+        """Run a coroutine on the loop thread, returning a Future for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _call(self, coroutine, timeout: float=None):
+        return self.submit(coroutine).result(timeout)
+
+    def close(self, timeout: float=10):
+        """Close the event stream and session, stop the loop thread and close the loop."""
+        if self._loop.is_closed():
+            return
+        try:
+            if self._loop.is_running():
+                self._call(self._close(), timeout)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            if not self._thread.is_alive():
+                self._loop.close()
+
+    async def _close(self):
+        noon = getattr(self, "_noon", None)
+        if noon is not None:
+            await noon.close_eventstream()
+            if noon._websocket_task is not None:
+                await asyncio.wait([noon._websocket_task])
+        if self._session is not None:
+            await self._session.close()
+
+    """ Commands """
+
+    def set_brightness_future(self, line_id: Guid, brightness_level: int, transition_time: int=None) -> concurrent.futures.Future:
+        return self.submit(self._line_command(line_id, "set_brightness", brightness_level, transition_time))
+
+    def set_brightness(self, line_id: Guid, brightness_level: int, transition_time: int=None, timeout: float=None) -> NoonCommand:
+        return self.set_brightness_future(line_id, brightness_level, transition_time).result(timeout)
+
+    def turn_on(self, line_id: Guid, timeout: float=None) -> NoonCommand:
+        return self.set_brightness(line_id, 100, timeout=timeout)
+
+    def turn_off(self, line_id: Guid, timeout: float=None) -> NoonCommand:
+        return self.set_brightness(line_id, 0, timeout=timeout)
+
+    def set_scene_future(self, space_id: Guid, active: bool=None, scene_id: Guid=None, scene_name: str=None) -> concurrent.futures.Future:
+        return self.submit(self._space_command(space_id, active, scene_id, scene_name))
+
+    def set_scene(self, space_id: Guid, active: bool=None, scene_id: Guid=None, scene_name: str=None, timeout: float=None) -> NoonCommand:
+        return self.set_scene_future(space_id, active, scene_id, scene_name).result(timeout)
+
+    def set_states_future(self, lines: typing.Dict=None, spaces: typing.Dict=None, transition_time: int=None) -> concurrent.futures.Future:
+        return self.submit(self._noon.set_states(lines, spaces, transition_time))
+
+    def set_states(self, lines: typing.Dict=None, spaces: typing.Dict=None, transition_time: int=None,
+            timeout: float=None) -> typing.List[NoonCommand]:
+        return self.set_states_future(lines, spaces, transition_time).result(timeout)
+
+    def wait_applied(self, command: NoonCommand, timeout: float=None) -> bool:
+        """Block until a command is confirmed, returning False if the timeout elapses."""
+        return self._call(command.applied(timeout))
+
+    async def _line_command(self, line_id: Guid, method: str, *args) -> NoonCommand:
+        line = self._noon.get_entity(line_id)
+        if not isinstance(line, NoonLine):
+            raise NoonInvalidParametersError("Line '{}' not found".format(line_id))
+        return await getattr(line, method)(*args)
+
+    async def _space_command(self, space_id: Guid, active: bool, scene_id: Guid, scene_name: str) -> NoonCommand:
+        space = self._noon.get_entity(space_id)
+        if not isinstance(space, NoonSpace):
+            raise NoonInvalidParametersError("Space '{}' not found".format(space_id))
+        return await space.set_scene(active, scene_id, scene_name)
+
+    """ State """
+
+    def snapshot(self, timeout: float=None) -> typing.Dict[str, typing.Dict]:
+        """Returns a consistent copy of the state of every space and line."""
+        return self._call(self._snapshot(), timeout)
+
+    async def _snapshot(self) -> typing.Dict[str, typing.Dict]:
+        """Build the snapshot in one step on the loop thread, so no event can interleave."""
+        spaces = {}
+        for guid, space in (self._noon._spaces or {}).items():
+            spaces[guid] = {"name": space.name, "lightsOn": space.lights_on, "activeScene": space.active_scene_id}
+        lines = {}
+        for guid, line in (self._noon._lines or {}).items():
+            lines[guid] = {"name": line.name, "space": line.parent_space.guid if line.parent_space is not None else None,
+                "lineState": line.line_state, "dimmingLevel": line.dimming_level}
+        return {"spaces": spaces, "lines": lines}
+
+    """ Events """
+
+    def subscribe(self, handler: NoonSyncEventHandler, executor: concurrent.futures.Executor=None):
+        """Call handler(entity_guid, event, params) for every event.
+
+        If executor is given the handler runs there; otherwise it runs on the
+        loop thread and must return quickly.
+        """
+        with self._handlers_lock:
+            self._handlers.append((handler, executor))
+
+    def unsubscribe(self, handler: NoonSyncEventHandler, executor: concurrent.futures.Executor=None):
+        with self._handlers_lock:
+            self._handlers.remove((handler, executor))
+
+    def event_queue(self, maxsize: int=0) -> queue.Queue:
+        """Returns a thread-safe queue that receives (entity_guid, event, params) for every event."""
+        events = queue.Queue(maxsize)
+        def enqueue(guid, event, params):
+            try:
+                events.put_nowait((guid, event, params))
+            except queue.Full:
+                _LOGGER.warning("Event queue full, dropping event for {}".format(guid))
+        self.subscribe(enqueue)
+        return events
+
+    async def _handle_event(self, entity: NoonEntity, context, event, params: typing.Dict):
+        with self._handlers_lock:
+            handlers = list(self._handlers)
+        for handler, executor in handlers:
+            if executor is not None:
+                executor.submit(handler, entity.guid, event, dict(params))
+                continue
+            try:
+                handler(entity.guid, event, dict(params))
+            except:
+                _LOGGER.exception("Exception handling update for {}".format(entity.name))
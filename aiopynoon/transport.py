@@ -0,0 +1,82 @@
+""" Connection profile for talking to Noon. """
+
+import logging
+import typing
+from aiohttp import ClientSession, ClientTimeout, ClientWSTimeout, TCPConnector
+from yarl import URL
+
+_LOGGER = logging.getLogger(__name__)
+
+""" Seconds between pings on the notification stream """
+NOTIFICATION_HEARTBEAT = 60
+
+""" Seconds an idle connection is kept open for reuse """
+KEEPALIVE_TIMEOUT = 300
+
+""" Seconds a DNS lookup is cached """
+DNS_CACHE_TTL = 3600
+
+""" Maximum simultaneous connections to each Noon host """
+CONNECTIONS_PER_HOST = 10
+
+""" Timeouts for queries and actions """
+REQUEST_TIMEOUT = ClientTimeout(total=20, connect=10, sock_connect=10, sock_read=15)
+
+""" Timeouts for the connected notification stream. Reads must outlast the heartbeat interval. """
+EVENTSTREAM_TIMEOUT = ClientWSTimeout(ws_receive=NOTIFICATION_HEARTBEAT * 2, ws_close=10)
+
+""" Seconds allowed for the notification stream handshake """
+EVENTSTREAM_CONNECT_TIMEOUT = 20
+
+
+def create_connector(limit_per_host: int=CONNECTIONS_PER_HOST) -> TCPConnector:
+    """Create a connector that keeps connections and DNS lookups warm."""
+    return TCPConnector(limit=0, limit_per_host=limit_per_host, keepalive_timeout=KEEPALIVE_TIMEOUT,
+        use_dns_cache=True, ttl_dns_cache=DNS_CACHE_TTL)
+
+
+def create_session(**kwargs) -> ClientSession:
+    """Create a ClientSession using the Noon connection profile.
+
+    Extra keyword arguments are passed to ClientSession.
+    """
+    kwargs.setdefault("connector", create_connector())
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    return ClientSession(**kwargs)
+
+
+class NoonEndpoints(object):
+    """Pre-built URLs for the endpoints assigned to an account."""
+
+    @property
+    def query(self) -> URL:
+        return self._query
+
+    @property
+    def notifications(self) -> URL:
+        return self._notifications
+
+    @property
+    def hosts(self) -> typing.List[URL]:
+        """Returns the base URL of each HTTP host, for pre-warming connections."""
+        return self._hosts
+
+    def __init__(self, endpoints: typing.Dict[str, str]):
+        """Build URLs from the endpoints returned by DEX."""
+        self._query = URL("{}/api/query".format(endpoints["query"]))
+        self._notifications = URL("{}/api/notifications".format(endpoints["notification-ws"]))
+        self._action_base = endpoints["action"]
+        self._actions = {}
+        self._hosts = []
+        for name in ("query", "action"):
+            host = URL(endpoints[name]).origin()
+            if host not in self._hosts:
+                self._hosts.append(host)
+
+    def action(self, action: str) -> URL:
+        """Returns the URL for an action (e.g. 'line/lightLevel')."""
+        url = self._actions.get(action, None)
+        if url is None:
+            url = URL("{}/api/action/{}".format(self._action_base, action))
+            self._actions[action] = url
+        return url
@@ -0,0 +1,93 @@
+""" Versioned record of state changes, for delta queries. """
+
+import logging
+import typing
+from collections import OrderedDict
+
+from .const import Guid
+
+_LOGGER = logging.getLogger(__name__)
+
+""" Most (entity, field) entries retained before the oldest are compacted away """
+DEFAULT_MAX_ENTRIES = 100000
+
+NoonChange = typing.Tuple[int, Guid, str, typing.Any]
+
+
+class NoonChanges(object):
+    """The result of a changes_since() query."""
+
+    def __init__(self, version: int, changes: typing.List[NoonChange], reset: bool):
+        self.version = version
+        self.changes = changes
+        self.reset = reset
+
+    def __repr__(self):
+        """Returns a stringified representation of this object."""
+        return str({'version': self.version, 'changes': self.changes, 'reset': self.reset})
+
+
+class NoonChangeLog(object):
+    """Stamps each field change with a monotonically increasing version.
+
+    Only the latest change to each (entity, field) is kept, ordered by
+    version, so memory is bounded by the number of fields rather than the
+    number of events, and changes_since() costs O(changes returned).
+    """
+
+    @property
+    def version(self) -> int:
+        """Returns the version of the most recent change."""
+        return self._version
+
+    @property
+    def floor(self) -> int:
+        """Returns the oldest version that can be queried without a reset."""
+        return self._floor
+
+    def __init__(self, max_entries: int=DEFAULT_MAX_ENTRIES):
+        self._version = 0
+        self._floor = 0
+        self._max_entries = max_entries
+        self._latest = OrderedDict()
+        self._entity_versions = {}
+
+    def record(self, guid: Guid, field: str, value) -> int:
+        """Record a field change, returning its version."""
+        self._version = self._version + 1
+        key = (guid, field)
+        self._latest[key] = (self._version, value)
+        self._latest.move_to_end(key)
+        self._entity_versions[guid] = self._version
+        while len(self._latest) > self._max_entries:
+            (old_guid, _), (old_version, _) = self._latest.popitem(last=False)
+            self._floor = old_version
+            if self._entity_versions.get(old_guid, None) == old_version:
+                del self._entity_versions[old_guid]
+        return self._version
+
+    def reset(self) -> int:
+        """Discard all changes (e.g. after rediscovery). Earlier versions will report a reset."""
+        self._version = self._version + 1
+        self._floor = self._version
+        self._latest.clear()
+        self._entity_versions.clear()
+        return self._version
+
+    def entity_version(self, guid: Guid) -> int:
+        """Returns the version of the latest change to an entity, or None."""
+        return self._entity_versions.get(guid, None)
+
+    def changes_since(self, version: int) -> NoonChanges:
+        """Returns the latest value of each field changed after version.
+
+        If version predates the retained history, reset is True and the
+        caller should reload the full state before applying the changes.
+        """
+        changes = []
+        for (guid, field), (change_version, value) in reversed(self._latest.items()):
+            if change_version <= version:
+                break
+            changes.append((change_version, guid, field, value))
+        changes.reverse()
+        return NoonChanges(self._version, changes, version < self._floor)
@@ -0,0 +1,195 @@
+""" User-defined zones grouping lines from several spaces """
+
+import logging
+import uuid
+from typing import Dict, List
+
+from .command import NoonCommand
+from .const import Guid
+from .entity import NoonEntity
+from .event import NoonEvent
+from .exceptions import NoonInvalidParametersError
+from .line import NoonLine, LINE_STATE_ON, LINE_STATE_OFF
+from .space import NoonSpace
+
+_LOGGER = logging.getLogger(__name__)
+
+ATTR_ANY_ON = "anyOn"
+ATTR_ALL_OFF = "allOff"
+ATTR_AVERAGE_DIM_LEVEL = "averageDimmingLevel"
+
+
+class NoonZone(NoonEntity):
+    """A named group of lines, given directly or by space, with aggregate state.
+
+    Each multiway group counts once, through its master. The aggregates are
+    kept up to date from member line events, adjusting running totals by the
+    difference each change makes, so an update costs the same however large
+    the zone is.
+    """
+
+    class Event(NoonEvent):
+        """Output events that can be generated.
+        ANY_ON_CHANGED: Whether any line in the zone is on has changed.
+            Params:
+            anyOn: Any line is on (boolean)
+        """
+        ANY_ON_CHANGED = 1
+
+        """
+        ALL_OFF_CHANGED: Whether every line in the zone is off has changed.
+            Params:
+            allOff: All lines are off (boolean)
+        """
+        ALL_OFF_CHANGED = 2
+
+        """
+        AVERAGE_DIM_LEVEL_CHANGED: The average dim level of the lines that are on has changed.
+            Params:
+            averageDimmingLevel: New average dim level percent (float, or None if no line is on)
+        """
+        AVERAGE_DIM_LEVEL_CHANGED = 3
+
+    @property
+    def lines(self) -> List[NoonLine]:
+        """Returns the lines in the zone, with multiway slaves replaced by their masters."""
+        return list(self._lines.values())
+
+    @property
+    def line_ids(self) -> List[Guid]:
+        """Returns the GUIDs of the lines this zone was defined with."""
+        return list(self._line_ids)
+
+    @property
+    def space_ids(self) -> List[Guid]:
+        """Returns the GUIDs of the spaces this zone was defined with."""
+        return list(self._space_ids)
+
+    @property
+    def lines_on(self) -> int:
+        return self._lines_on
+
+    @property
+    def any_on(self) -> bool:
+        return self._lines_on > 0
+
+    @property
+    def all_off(self) -> bool:
+        return self._lines_off == len(self._lines)
+
+    @property
+    def average_dimming_level(self) -> float:
+        """Returns the average dim level of the lines that are on, or None if none are."""
+        if self._level_count == 0:
+            return None
+        return self._level_sum / self._level_count
+
+    def __init__(self, noon, name: str, line_ids: List[Guid]=None, space_ids: List[Guid]=None, guid: Guid=None):
+        """Initializes the Zone. Members are looked up when the zone is bound."""
+        self._line_ids = list(line_ids or [])
+        self._space_ids = list(space_ids or [])
+        self._lines = {}
+        self._states = {}
+        self._lines_on = 0
+        self._lines_off = 0
+        self._level_sum = 0
+        self._level_count = 0
+
+        super().__init__(noon, guid or uuid.uuid4().hex, name)
+
+    def _bind(self):
+        """Subscribe to the current member lines and recount the aggregates.
+
+        Called when the zone is created and again after each discovery, as
+        discovery replaces every line.
+        """
+        self._unbind()
+        lines = []
+        for line_id in self._line_ids:
+            line = self._noon.get_entity(line_id)
+            if not isinstance(line, NoonLine):
+                _LOGGER.warning("Line {} in zone '{}' not found".format(line_id, self.name))
+                continue
+            lines.append(line)
+        for space_id in self._space_ids:
+            space = self._noon.get_entity(space_id)
+            if not isinstance(space, NoonSpace):
+                _LOGGER.warning("Space {} in zone '{}' not found".format(space_id, self.name))
+                continue
+            lines.extend(self._noon.lines_in_space(space_id))
+
+        for line in lines:
+            line = line.multiway_master or line
+            if line.guid in self._lines:
+                continue
+            self._lines[line.guid] = line
+            self._states[line.guid] = (line.line_state, line.dimming_level)
+            self._count(line.line_state, line.dimming_level, 1)
+            line.subscribe(self._handle_line_event, None)
+
+    def _unbind(self):
+        for line in self._lines.values():
+            line.unsubscribe(self._handle_line_event, None)
+        self._lines = {}
+        self._states = {}
+        self._lines_on = 0
+        self._lines_off = 0
+        self._level_sum = 0
+        self._level_count = 0
+
+    def _count(self, line_state: str, dimming_level: int, sign: int):
+        """Add (sign=1) or remove (sign=-1) one line's contribution to the totals."""
+        if line_state == LINE_STATE_ON:
+            self._lines_on += sign
+            if dimming_level is not None:
+                self._level_sum += sign * dimming_level
+                self._level_count += sign
+        elif line_state == LINE_STATE_OFF:
+            self._lines_off += sign
+
+    async def _handle_line_event(self, line: NoonLine, context, event, params: Dict):
+        if event != NoonLine.Event.LINE_STATE_CHANGED and event != NoonLine.Event.DIM_LEVEL_CHANGED:
+            return
+        new_state = (line.line_state, line.dimming_level)
+        old_state = self._states.get(line.guid, None)
+        if old_state is None or old_state == new_state:
+            return
+
+        any_on, all_off, average = self.any_on, self.all_off, self.average_dimming_level
+        self._count(*old_state, -1)
+        self._count(*new_state, 1)
+        self._states[line.guid] = new_state
+
+        if self.any_on != any_on:
+            await self._dispatch_event(NoonZone.Event.ANY_ON_CHANGED, {ATTR_ANY_ON: self.any_on})
+        if self.all_off != all_off:
+            await self._dispatch_event(NoonZone.Event.ALL_OFF_CHANGED, {ATTR_ALL_OFF: self.all_off})
+        if self.average_dimming_level != average:
+            await self._dispatch_event(NoonZone.Event.AVERAGE_DIM_LEVEL_CHANGED,
+                {ATTR_AVERAGE_DIM_LEVEL: self.average_dimming_level})
+
+    async def set_brightness(self, brightness_level: int, transition_time: int=None) -> List[NoonCommand]:
+        """Set every line in the zone to the same brightness, using as few actions as possible."""
+        return await self._noon.set_states({line: brightness_level for line in self._lines.values()},
+            transition_time=transition_time)
+
+    async def turn_on(self) -> List[NoonCommand]:
+
+        return await self.set_brightness(100)
+
+    async def turn_off(self) -> List[NoonCommand]:
+
+        return await self.set_brightness(0)
+
+    async def handle_update(self, changed_fields):
+        """Zones are local, so Noon never sends updates for them."""
+        raise NoonInvalidParametersError("Zone '{}' cannot be updated from Noon".format(self.name))
+
+    def to_json(self) -> Dict:
+        """Returns the zone definition."""
+        return {"guid": self.guid, "name": self.name, "lines": self._line_ids, "spaces": self._space_ids}
+
+    def __repr__(self):
+        """Returns a stringified representation of this object."""
+        return str({'name': self.name, 'lines': len(self._lines), 'anyOn': self.any_on,
+            'allOff': self.all_off, 'averageDimmingLevel': self.average_dimming_level, 'id': self.guid})
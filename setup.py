@@ -12,7 +12,8 @@ setuptools.setup(
     url = 'http://github.com/alistairg/aiopynoon',
     include_package_data=True,
 	packages=setuptools.find_packages(),
-    install_requires=['aiohttp'],
+    install_requires=['aiohttp>=3.10'],
+    extras_require={'numpy': ['numpy']},
     classifiers = [
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: MIT License',
@@ -29,6 +29,24 @@ async def test_lines(noon):
     lines = await noon.lines
     assert len(lines) > 0
 
+# ...which should be indexed by name, space and state
+async def test_line_indexes(noon):
+    lines = await noon.lines
+    for line in lines.values():
+        assert line in noon.lines_named(line.name)
+        assert line in noon.lines_in_space(line.parent_space.guid)
+        assert line in noon.lines_with_state(line.line_state)
+
+# ...a zone over every space should agree with its lines
+async def test_zone_aggregates(noon):
+    spaces = await noon.spaces
+    zone = await noon.add_zone("Everywhere", spaces=list(spaces.values()))
+    assert len(zone.lines) > 0
+    assert zone.any_on == any(line.line_state == LINE_STATE_ON for line in zone.lines)
+    assert zone.all_off == all(line.line_state == LINE_STATE_OFF for line in zone.lines)
+    noon.remove_zone(zone)
+    assert noon.get_entity(zone.guid) is None
+
 # ...we should have multiple scenes in each space
 async def test_scenes_exist(noon):
     spaces = await noon.spaces
@@ -130,6 +148,22 @@ async def test_line_change_2(noon):
     assert first_line.line_state == expected_state, "Line 'line_state' not correctly updated" 
 
 
+# Test waiting for a line change to be confirmed
+async def test_line_change_applied(noon):
+    lines = await noon.lines
+    first_line = next(iter(lines.values()))
+    if first_line.line_state == LINE_STATE_ON:
+        command = await first_line.turn_off()
+        expected_state = LINE_STATE_OFF
+    else:
+        command = await first_line.turn_on()
+        expected_state = LINE_STATE_ON
+    assert command.tid != 55555, "Transaction ID not generated"
+    assert await command.applied(timeout=10), "Command not confirmed"
+    assert command.latency is not None, "Latency not recorded"
+    assert first_line.line_state == expected_state, "Line 'line_state' not correctly updated"
+
+
 # Test toggling the lights in a space
 async def test_space_toggle_lights_1(noon):
     spaces = await noon.spaces
@@ -274,7 +308,12 @@ async def test_close_eventstream(noon):
         else:
             seconds_remaining = seconds_remaining - 1
     assert noon.event_stream_connected == False, "Still connected to event stream"
-        
-
 
 
+# Test pipelined start-up
+async def test_start(noon):
+    await noon.start()
+    assert noon.event_stream_connected == True, "Not connected to event stream"
+    lines = await noon.lines
+    assert len(lines) > 0
+    await noon.close_eventstream()
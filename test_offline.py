@@ -0,0 +1,887 @@
+import aiohttp
+import asyncio
+import json
+import mock
+import os
+import sqlite3
+import stat
+import time
+import pytest
+
+from aiopynoon import Noon
+from aiopynoon.exceptions import NoonCommunicationError, NoonInvalidParametersError, NoonProtocolError
+from aiopynoon.line import ATTR_DIM_LEVEL, ATTR_LINE_STATE, LINE_STATE_OFF, LINE_STATE_ON, NoonLine
+from aiopynoon.metrics import NoonMetrics, RATE_WINDOW
+from aiopynoon.planner import NoonPlanner
+from aiopynoon.polling import NoonPoller, state_changes
+from aiopynoon.relay import NoonRelayServer
+from aiopynoon.scheduler import NoonScheduler
+from aiopynoon.sharding import NoonHashRing, NoonShardedRunner
+from aiopynoon.sqlite_sink import NoonSQLiteSink
+from aiopynoon.sync import NoonSync
+from aiopynoon.versions import NoonChangeLog
+from aiopynoon.zone import NoonZone
+from aiopynoon.replay import NoonReplay
+
+# These tests need no Noon account: they run against a NoonReplay recording
+pytestmark = pytest.mark.asyncio
+
+DISCOVERY = {"spaces": [
+    {"guid": "S1", "name": "Kitchen", "lightsOn": True, "activeScene": {"guid": "SC1"},
+     "lines": [{"guid": "L1", "displayName": "Pendant", "lineState": "on", "dimmingLevel": 80, "multiwayMaster": None},
+               {"guid": "L2", "displayName": "Pendant Switch", "lineState": "on", "dimmingLevel": 80, "multiwayMaster": {"guid": "L1"}},
+               {"guid": "L3", "displayName": "Under Cabinet", "lineState": "on", "dimmingLevel": 50, "multiwayMaster": None}],
+     "scenes": [{"guid": "SC1", "name": "Bright"}, {"guid": "SC2", "name": "Dim"}]},
+    {"guid": "S2", "name": "Hall", "lightsOn": False, "activeScene": {"guid": "SC3"},
+     "lines": [{"guid": "L4", "displayName": "Ceiling", "lineState": "off", "dimmingLevel": 30, "multiwayMaster": None},
+               {"guid": "L5", "displayName": "Lamp", "lineState": "off", "dimmingLevel": 60, "multiwayMaster": None}],
+     "scenes": [{"guid": "SC3", "name": "Evening"}]},
+]}
+
+
+class _Response(object):
+    """Just enough of an aiohttp response for Noon's login, endpoint and action requests."""
+
+    def __init__(self, status, body):
+        self.status = status
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class _FlakySession(object):
+    """A session whose logins fail with a dropped connection a given number of times, and whose actions raise the given errors first."""
+
+    def __init__(self, login_failures, action_failures=()):
+        self.login_failures = login_failures
+        self.action_failures = list(action_failures)
+        self.actions = []
+
+    def post(self, url, **kwargs):
+        url = str(url)
+        if "login" in url:
+            if self.login_failures > 0:
+                self.login_failures = self.login_failures - 1
+                raise aiohttp.ServerDisconnectedError()
+            return _Response(200, {"token": "token", "lifetime": 3600})
+        if len(self.action_failures) > 0:
+            raise self.action_failures.pop(0)
+        self.actions.append((url, kwargs["json"]))
+        return _Response(200, {})
+
+    def get(self, url, **kwargs):
+        return _Response(200, {"endpoints": {"query": "https://query.example/api/query",
+            "action": "https://action.example/api/action", "notification-ws": "wss://notify.example/ws"}})
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = tmp_path / "recording.jsonl"
+    path.write_text(json.dumps({"discovery": DISCOVERY}) + "\n")
+    return str(path)
+
+
+async def _started(recording, **kwargs) -> NoonReplay:
+    noon = NoonReplay(recording, **kwargs)
+    await noon.start()
+    return noon
+
+
+async def _line_change(noon, guid, line_state):
+    await noon._handle_change({"guid": guid, "fields": [{"name": ATTR_LINE_STATE, "value": line_state}]})
+
+
+# An older command landing must not revert a newer optimistic change
+async def test_optimistic_superseded_command(recording):
+    noon = await _started(recording, optimistic=True)
+    await noon.close_eventstream()
+    line = noon.get_entity("L3")
+    callback = mock.AsyncMock()
+    line.subscribe(callback, None)
+
+    await line.turn_off()
+    await line.turn_on()
+    assert line.line_state == LINE_STATE_ON
+
+    await _line_change(noon, "L3", LINE_STATE_OFF)
+    assert line.line_state == LINE_STATE_ON
+    events = [call.args[2] for call in callback.call_args_list]
+    assert NoonLine.Event.CHANGE_REVERTED not in events
+
+    await _line_change(noon, "L3", LINE_STATE_ON)
+    assert line.line_state == LINE_STATE_ON
+    assert callback.call_args.args[2] == NoonLine.Event.CHANGE_CONFIRMED
+    assert callback.call_args.args[3] == {ATTR_LINE_STATE: LINE_STATE_ON}
+
+
+# A notification that contradicts the newest command reverts it
+async def test_optimistic_contradicted(recording):
+    noon = await _started(recording, optimistic=True)
+    await noon.close_eventstream()
+    line = noon.get_entity("L3")
+    callback = mock.AsyncMock()
+    line.subscribe(callback, None)
+
+    await line.set_brightness(20)
+    await line.set_brightness(40)
+    await noon._handle_change({"guid": "L3", "fields": [{"name": "dimmingLevel", "value": 65}]})
+    assert line.dimming_level == 65
+    assert callback.call_args.args[2] == NoonLine.Event.CHANGE_REVERTED
+
+
+# Repeating a command before Noon confirms the first waits for Noon, not for the optimistic local state
+async def test_optimistic_repeated_command(recording):
+    noon = await _started(recording, optimistic=True)
+    await noon.close_eventstream()
+    line = noon.get_entity("L3")
+    first = await line.set_brightness(40)
+    second = await line.set_brightness(40)
+    assert second.expected == {"dimmingLevel": 40}
+    assert not first.done and not second.done
+
+    await noon._handle_change({"guid": "L3", "fields": [{"name": "dimmingLevel", "value": 40}]}, first.tid)
+    assert await first.applied(1) == True
+    assert not second.done
+    await noon._handle_change({"guid": "L3", "fields": [{"name": "dimmingLevel", "value": 40}]}, second.tid)
+    assert await second.applied(1) == True
+
+
+# A command nothing confirms expires, even if no other command is sent
+async def test_command_expires(recording, monkeypatch):
+    monkeypatch.setattr("aiopynoon.noon.COMMAND_EXPIRY", 0.05)
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    command = await noon.get_entity("L3").set_brightness(40)
+    assert await asyncio.wait_for(command.applied(), 5) == False
+    assert noon.pending_command_count == 0
+
+
+# A change to a different value (e.g. from a wall switch) does not confirm a command
+async def test_command_matches_values(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    command = await noon.get_entity("L3").set_brightness(40)
+    await noon._handle_change({"guid": "L3", "fields": [{"name": "dimmingLevel", "value": 70}]})
+    assert not command.done
+    await noon._handle_change({"guid": "L3", "fields": [{"name": "dimmingLevel", "value": 40}]})
+    assert await command.applied(1) == True
+
+
+# A dropped connection while logging in before an action is retried
+async def test_action_login_retried():
+    session = _FlakySession(login_failures=2)
+    noon = Noon(session, "user", "password", action_backoff=0)
+    await noon._post_action("line/lightLevel", {"line": "L1", "lightLevel": 50})
+    assert len(session.actions) == 1
+
+    session = _FlakySession(login_failures=10)
+    noon = Noon(session, "user", "password", action_backoff=0)
+    with pytest.raises(NoonCommunicationError):
+        await noon._post_action("line/lightLevel", {"line": "L1", "lightLevel": 50})
+    assert len(session.actions) == 0
+
+
+# Timeouts and truncated responses are retried for idempotent actions, and otherwise raised as NoonCommunicationError
+async def test_action_errors_retried():
+    session = _FlakySession(0, [asyncio.TimeoutError(), aiohttp.ClientPayloadError("truncated")])
+    noon = Noon(session, "user", "password", action_backoff=0)
+    await noon._post_action("line/lightLevel", {"line": "L1", "lightLevel": 50})
+    assert len(session.actions) == 1
+
+    for error in (asyncio.TimeoutError(), aiohttp.ClientPayloadError("truncated")):
+        session = _FlakySession(0, [error])
+        noon = Noon(session, "user", "password", action_backoff=0)
+        with pytest.raises(NoonCommunicationError):
+            await noon._post_action("line/lightLevel", {"line": "L1", "lightLevel": 50}, idempotent=False)
+        assert len(session.actions) == 0
+
+
+class _SlowHandshakeReplay(NoonReplay):
+    """A replay whose event stream only connects once the test allows it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handshake = asyncio.Event()
+
+    async def _internal_eventstream(self):
+        await self.handshake.wait()
+        await super()._internal_eventstream()
+
+
+# A change made after the discovery snapshot but before the stream subscribes is not lost
+async def test_start_reconciles_handshake_window(recording):
+    noon = _SlowHandshakeReplay(recording)
+    starting = asyncio.ensure_future(noon.start())
+    while noon._lines is None:
+        await asyncio.sleep(0.01)
+    assert noon.get_entity("L4").line_state == LINE_STATE_OFF
+
+    noon._replay_emit({"guid": "L4", "fields": [{"name": ATTR_LINE_STATE, "value": LINE_STATE_ON}]})
+    noon.handshake.set()
+    await asyncio.wait_for(starting, 5)
+    assert noon.get_entity("L4").line_state == LINE_STATE_ON
+    await noon.close_eventstream()
+
+
+# Changes made while the stream is down are picked up on reconnect
+async def test_reconnect_reconciles(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    await asyncio.sleep(0)
+    noon._replay_emit({"guid": "L5", "fields": [{"name": ATTR_LINE_STATE, "value": LINE_STATE_ON}]})
+    assert noon.get_entity("L5").line_state == LINE_STATE_OFF
+    assert await noon.reconnect() == 1
+    assert noon.get_entity("L5").line_state == LINE_STATE_ON
+    await noon.close_eventstream()
+
+
+class _StreamSession(_FlakySession):
+    """A session that records how the event stream was opened, then refuses it."""
+
+    def __init__(self):
+        super().__init__(login_failures=0)
+        self.ws_kwargs = None
+
+    async def ws_connect(self, url, **kwargs):
+        self.ws_kwargs = kwargs
+        raise aiohttp.ClientConnectionError()
+
+
+# The event stream gets websocket timeouts, so reads time out after two missed heartbeats
+async def test_eventstream_timeouts():
+    session = _StreamSession()
+    noon = Noon(session, "user", "password")
+    await noon._internal_eventstream()
+    timeout = session.ws_kwargs["timeout"]
+    assert isinstance(timeout, aiohttp.ClientWSTimeout)
+    assert timeout.ws_receive == session.ws_kwargs["heartbeat"] * 2
+
+
+def _planned(actions):
+    return [(action.entity.guid, action.value) for action in actions]
+
+
+# Lines in a space being switched on still get their own action, even if already in the desired state
+async def test_plan_activated_space(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    planner = NoonPlanner(noon)
+    assert _planned(planner.plan(lines={"L4": 0}, spaces={"S2": True})) == [("S2", True), ("L4", 0)]
+    assert _planned(planner.plan(lines={"L4": 0, "L5": 40}, spaces={"S2": True})) == [("S2", True), ("L4", 0), ("L5", 40)]
+
+    # A space that is already on needs no action, so satisfied lines in it are still skipped
+    assert _planned(planner.plan(lines={"L3": 50}, spaces={"S1": True})) == []
+
+
+# Turning off every line in a space becomes one space action
+async def test_plan_all_off_collapses(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    planner = NoonPlanner(noon)
+    assert _planned(planner.plan(lines={"L1": 0, "L2": 0, "L3": 0})) == [("S1", False)]
+    assert _planned(planner.plan(lines={"L1": 0, "L3": 0})) == [("S1", False)]
+    assert _planned(planner.plan(lines={"L3": 0})) == [("L3", 0)]
+
+
+# Multiway slaves are folded into their master
+async def test_plan_folds_multiway(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    planner = NoonPlanner(noon)
+    assert _planned(planner.plan(lines={"L2": 40})) == [("L1", 40)]
+    assert _planned(planner.plan(lines={"L1": 40, "L2": 40})) == [("L1", 40)]
+    assert _planned(planner.plan(lines={"L2": 80})) == []
+
+
+async def _relay_request(reader, writer, request):
+    writer.write(json.dumps(request).encode("utf-8") + b"\n")
+    await writer.drain()
+    return json.loads(await asyncio.wait_for(reader.readline(), 5))
+
+
+# The relay socket is private, and only well-formed requests for known actions are forwarded
+async def test_relay_rejects_requests(recording, tmp_path):
+    noon = await _started(recording)
+    path = str(tmp_path / "relay.sock")
+    relay = NoonRelayServer(noon, path)
+    await relay.start()
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        reader, writer = await asyncio.open_unix_connection(path)
+
+        reply = await _relay_request(reader, writer, [1, 2])
+        assert reply == {"id": None, "error": "NoonInvalidParametersError", "message": "Request must be an object"}
+
+        reply = await _relay_request(reader, writer, {"id": 1, "op": "action", "action": "../query", "payload": {}})
+        assert reply["id"] == 1 and reply["error"] == "NoonInvalidParametersError"
+
+        reply = await _relay_request(reader, writer, {"id": 2, "op": "action", "action": "line/lightLevel", "payload": [1]})
+        assert reply["id"] == 2 and reply["error"] == "NoonInvalidParametersError"
+
+        reply = await _relay_request(reader, writer, {"id": 3, "op": "action", "action": "line/lightLevel",
+            "payload": {"line": "L3", "lightLevel": 20}})
+        assert reply == {"id": 3, "result": None}
+        writer.close()
+    finally:
+        await relay.stop()
+        await noon.close_eventstream()
+
+
+# Stopping the sink writes queued events, including when the queue is full
+async def test_sqlite_sink_stop(recording, tmp_path):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    path = str(tmp_path / "events.db")
+    sink = NoonSQLiteSink(path, flush_interval=60, max_queued=2)
+    sink.attach(noon)
+    sink.start()
+    for guid in ("L3", "L4", "L5"):
+        await _line_change(noon, guid, LINE_STATE_ON if guid != "L3" else LINE_STATE_OFF)
+    assert sink.dropped == 1
+    await asyncio.wait_for(sink.stop(), 5)
+
+    with sqlite3.connect(path) as connection:
+        rows = connection.execute("SELECT guid FROM noon_events ORDER BY rowid").fetchall()
+    assert rows == [("L3",), ("L4",)]
+    assert sink.written == 2
+
+
+# The ring spreads keys over every node, and adding a node only moves keys onto it
+async def test_hash_ring():
+    keys = ["account-{}".format(index) for index in range(2000)]
+    ring = NoonHashRing(range(4))
+    owners = {key: ring.node_for(key) for key in keys}
+    assert owners == {key: NoonHashRing(range(4)).node_for(key) for key in keys}
+    for node in range(4):
+        assert 300 < list(owners.values()).count(node) < 700
+
+    grown = NoonHashRing(range(5))
+    moved = [key for key in keys if grown.node_for(key) != owners[key]]
+    assert all(grown.node_for(key) == 4 for key in moved)
+    assert 200 < len(moved) < 600
+
+
+# Accounts are kept by the worker the ring assigns them to
+async def test_sharded_routing():
+    runner = NoonShardedRunner(workers=3)
+    for index in range(30):
+        await runner.add_account("account-{}".format(index), "user", "password")
+    for shard in runner._shards:
+        assert all(runner.shard_for(account_id) == shard.index for account_id in shard.accounts)
+    assert sum(len(shard.accounts) for shard in runner._shards) == 30
+    await runner.remove_account("account-0")
+    assert sum(len(shard.accounts) for shard in runner._shards) == 29
+
+
+# Worker errors keep their type in the parent, and a worker that dies is restarted
+async def test_sharded_errors_and_restart():
+    runner = NoonShardedRunner(workers=2)
+    await runner.start()
+    try:
+        with pytest.raises(NoonInvalidParametersError):
+            await asyncio.wait_for(runner.command("missing", "L1", "turn_on"), 30)
+
+        shard = runner._shards[runner.shard_for("missing")]
+        shard.process.kill()
+        for _ in range(100):
+            await asyncio.sleep(0.1)
+            if shard.restarts == 1 and shard.process.is_alive():
+                break
+        assert shard.restarts == 1
+        assert await asyncio.wait_for(runner.health(), 30) == {}
+        with pytest.raises(NoonInvalidParametersError):
+            await asyncio.wait_for(runner.command("missing", "L1", "turn_on"), 30)
+    finally:
+        await runner.stop()
+
+
+# Delta queries return the latest value of each changed field, and report a reset after rediscovery
+async def test_changes_since(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    start = noon.state_version
+    assert noon.changes_since(start).changes == []
+
+    await _line_change(noon, "L3", LINE_STATE_OFF)
+    middle = noon.state_version
+    await _line_change(noon, "L4", LINE_STATE_ON)
+    await _line_change(noon, "L3", LINE_STATE_ON)
+    changes = noon.changes_since(start)
+    assert [(guid, field, value) for _, guid, field, value in changes.changes] == \
+        [("L4", ATTR_LINE_STATE, LINE_STATE_ON), ("L3", ATTR_LINE_STATE, LINE_STATE_ON)]
+    assert changes.version == noon.state_version and not changes.reset
+    assert [guid for _, guid, _, _ in noon.changes_since(middle).changes] == ["L4", "L3"]
+    assert noon.entity_version("L3") == noon.state_version
+
+    await noon._loadDevices()
+    changes = noon.changes_since(changes.version)
+    assert changes.reset and changes.changes == []
+    assert noon.entity_version("L3") is None
+
+
+# Versions older than the compacted history report a reset, newer ones do not
+async def test_changes_compaction_floor(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    noon._changelog = NoonChangeLog(max_entries=2)
+    await _line_change(noon, "L3", LINE_STATE_OFF)
+    first = noon.state_version
+    await _line_change(noon, "L4", LINE_STATE_ON)
+    await _line_change(noon, "L5", LINE_STATE_ON)
+    assert noon._changelog.floor == first
+
+    changes = noon.changes_since(first - 1)
+    assert changes.reset
+    changes = noon.changes_since(first)
+    assert not changes.reset
+    assert [guid for _, guid, _, _ in changes.changes] == ["L4", "L5"]
+    assert noon.entity_version("L3") is None
+
+
+# Line changes are recorded per entity until the budget runs out
+async def test_history_records_changes(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    history = await noon.enable_history(budget=32)
+    assert history.capacity == 16
+
+    await _line_change(noon, "L3", LINE_STATE_OFF)
+    await _line_change(noon, "L3", LINE_STATE_ON)
+    await _line_change(noon, "L4", LINE_STATE_ON)
+    await _line_change(noon, "L5", LINE_STATE_ON)
+    assert [value for _, _, value in history.last("L3", 60)] == [LINE_STATE_OFF, LINE_STATE_ON]
+    assert [field for _, field, _ in history.range("L4")] == [ATTR_LINE_STATE]
+    assert history.range("L5") == []
+
+
+# Once a ring wraps, only the newest samples are kept, and range() still searches them in order
+async def test_history_ring_wrap(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    history = await noon.enable_history(budget=32)
+    for index in range(40):
+        history.record("L3", ATTR_DIM_LEVEL, index, timestamp=1000 + index)
+        history.record("L3", ATTR_LINE_STATE, LINE_STATE_ON, timestamp=1000 + index + 0.5)
+
+    samples = history.range("L3")
+    assert len(samples) == 16
+    assert samples[0] == (1032, ATTR_DIM_LEVEL, 32)
+    assert samples[-1] == (1039.5, ATTR_LINE_STATE, LINE_STATE_ON)
+    assert [value for _, _, value in history.range("L3", 1035, 1037, field=ATTR_DIM_LEVEL)] == [35, 36, 37]
+    assert [timestamp for timestamp, _, _ in history.range("L3", 1035.2, 1036.2)] == [1035.5, 1036]
+    assert history.range("L3", start=0)[0][0] == 1032
+    assert history.range("L3", start=1040) == []
+    assert history.range("L3", end=1000) == []
+
+
+async def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        await asyncio.sleep(0.01)
+
+
+# Cancelled actions never run, and rescheduled ones run at their new time
+async def test_scheduler_cancel_reschedule(recording):
+    noon = await _started(recording)
+    scheduler = NoonScheduler(noon)
+    await scheduler.start()
+    try:
+        now = time.time()
+        scheduler.schedule_brightness("L3", 20, now + 0.1)
+        cancelled = scheduler.schedule_brightness("L4", 40, now + 0.1)
+        moved = scheduler.schedule_brightness("L5", 70, now + 3600)
+        assert scheduler.cancel(cancelled)
+        assert not scheduler.cancel(cancelled)
+        assert not scheduler.reschedule(cancelled, now)
+        assert scheduler.reschedule(moved, now + 0.2)
+        assert [action.target for action in scheduler.pending] == ["L3", "L5"]
+
+        await _wait_for(lambda: noon.get_entity("L5").dimming_level == 70)
+        assert noon.get_entity("L3").dimming_level == 20
+        assert noon.get_entity("L4").line_state == LINE_STATE_OFF
+        assert scheduler.pending == []
+        assert scheduler._peek() is None
+    finally:
+        await scheduler.stop()
+        await noon.close_eventstream()
+
+
+# An action for an entity that no longer exists does not stop the actions due with it
+async def test_scheduler_skips_unknown_targets(recording):
+    noon = await _started(recording)
+    scheduler = NoonScheduler(noon)
+    await scheduler.start()
+    try:
+        now = time.time()
+        scheduler.schedule_brightness("L3", 20, now + 0.1)
+        scheduler.schedule_brightness("GONE", 40, now + 0.1)
+        scheduler.schedule_scene("S2", now + 0.1, active=True)
+        scheduler.schedule_scene("L4", now + 0.1, active=True)
+        await _wait_for(lambda: noon.get_entity("L3").dimming_level == 20 and noon.get_entity("S2").lights_on)
+        assert scheduler.pending == []
+    finally:
+        await scheduler.stop()
+        await noon.close_eventstream()
+
+
+# Pending actions are saved on stop and reloaded, with their changes, by the next scheduler
+async def test_scheduler_persistence(recording, tmp_path):
+    noon = await _started(recording)
+    store_path = str(tmp_path / "schedule.json")
+    now = time.time()
+    scheduler = NoonScheduler(noon, store_path=store_path)
+    await scheduler.start()
+    kept = scheduler.schedule_scene("S2", now + 3600, active=True)
+    cancelled = scheduler.schedule_brightness("L3", 20, now + 3600)
+    moved = scheduler.schedule_brightness("L4", 40, now + 3600)
+    scheduler.cancel(cancelled)
+    scheduler.reschedule(moved, now + 7200)
+    await scheduler.stop()
+
+    reloaded = NoonScheduler(noon, store_path=store_path)
+    await reloaded.start()
+    try:
+        assert [(action.action_id, action.due) for action in reloaded.pending] == [(kept, now + 3600), (moved, now + 7200)]
+        assert reloaded.reschedule(moved, time.time())
+        await _wait_for(lambda: noon.get_entity("L4").dimming_level == 40)
+        assert [action.action_id for action in reloaded.pending] == [kept]
+    finally:
+        await reloaded.stop()
+        await noon.close_eventstream()
+    with open(store_path) as store:
+        assert [action["id"] for action in json.load(store)] == [kept]
+
+
+class _CountingReplay(NoonReplay):
+    """A replay that counts full discovery and state queries."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.discoveries = 0
+        self.state_queries = 0
+
+    async def _queryDevices(self):
+        self.discoveries = self.discoveries + 1
+        return await super()._queryDevices()
+
+    async def _queryState(self):
+        self.state_queries = self.state_queries + 1
+        return await super()._queryState()
+
+
+class _LateDiscoveryReplay(_CountingReplay):
+    """A replay whose discovery is only sent once the event stream has connected."""
+
+    async def _loadDevices(self):
+        await self._stream_ready.wait()
+        await super()._loadDevices()
+
+
+# Starting makes one discovery, and only reads the state again if discovery may have predated the stream
+async def test_start_queries(recording):
+    noon = _CountingReplay(recording)
+    await noon.start()
+    assert (noon.discoveries, noon.state_queries) == (1, 1)
+    await noon.close_eventstream()
+
+    noon = _LateDiscoveryReplay(recording)
+    await noon.start()
+    assert (noon.discoveries, noon.state_queries) == (1, 0)
+    await noon.close_eventstream()
+
+
+class _WebSocket(object):
+    """A connected notification stream that never sends anything."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.Event().wait()
+
+
+class _PollingSession(_FlakySession):
+    """A session serving discovery and state queries, whose notification stream is down until allowed."""
+
+    def __init__(self):
+        super().__init__(login_failures=0)
+        self.state = json.loads(json.dumps(DISCOVERY))
+        self.stream_up = False
+
+    def post(self, url, **kwargs):
+        if "query" in str(url):
+            return _Response(200, json.loads(json.dumps(self.state)))
+        return super().post(url, **kwargs)
+
+    async def ws_connect(self, url, **kwargs):
+        if not self.stream_up:
+            raise aiohttp.ClientConnectionError()
+        return _WebSocket()
+
+
+# With the fallback on, start() returns once polling has taken over, and the stream takes back over when it recovers
+async def test_start_falls_back_to_polling():
+    session = _PollingSession()
+    noon = Noon(session, "user", "password", polling_fallback=True, stream_retry_interval=0.05)
+    await asyncio.wait_for(noon.start(timeout=5), 2)
+    try:
+        assert noon.polling and not noon.event_stream_connected
+
+        session.state["spaces"][1]["lines"][0]["lineState"] = LINE_STATE_ON
+        noon._poller.poke()
+        await _wait_for(lambda: noon.get_entity("L4").line_state == LINE_STATE_ON)
+
+        session.state["spaces"][1]["lines"][1]["lineState"] = LINE_STATE_ON
+        session.stream_up = True
+        await _wait_for(lambda: noon.event_stream_connected and not noon.polling)
+        assert noon.get_entity("L5").line_state == LINE_STATE_ON
+    finally:
+        await noon.close_eventstream()
+        await asyncio.wait([noon._websocket_task])
+
+
+# Without the fallback, start() still fails when the stream cannot connect
+async def test_start_without_fallback_fails():
+    noon = Noon(_PollingSession(), "user", "password")
+    with pytest.raises(NoonProtocolError):
+        await asyncio.wait_for(noon.start(timeout=5), 2)
+    assert not noon.polling
+
+
+# Only fields that differ from the current state become changes
+async def test_poll_state_changes(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    state = json.loads(json.dumps(DISCOVERY))
+    assert state_changes(noon, state) == []
+
+    state["spaces"][0]["lightsOn"] = "false"
+    state["spaces"][1]["activeScene"] = {"guid": "SC4"}
+    state["spaces"][1]["lines"][1]["dimmingLevel"] = 25
+    state["spaces"][1]["lines"].append({"guid": "L9", "lineState": "on", "dimmingLevel": 10})
+    assert state_changes(noon, state) == [
+        {"guid": "S1", "fields": [{"name": "lightsOn", "value": False}]},
+        {"guid": "S2", "fields": [{"name": "activeScene", "value": {"guid": "SC4"}}]},
+        {"guid": "L5", "fields": [{"name": "dimmingLevel", "value": 25}]}]
+
+
+class _RecordingPoller(NoonPoller):
+    """A poller that notes the interval in effect at each poll."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.intervals = []
+
+    async def poll_once(self) -> int:
+        self.intervals.append(self.interval)
+        return await super().poll_once()
+
+
+# The interval grows while nothing changes, and drops back once a poll finds a change
+async def test_poll_interval_adapts(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    await asyncio.sleep(0)
+    poller = _RecordingPoller(noon, min_interval=0.01, max_interval=0.04, growth=2)
+    poller.start()
+    try:
+        await _wait_for(lambda: len(poller.intervals) >= 4)
+        assert poller.intervals[:4] == [0.01, 0.02, 0.04, 0.04]
+
+        noon._replay_emit({"guid": "L5", "fields": [{"name": ATTR_LINE_STATE, "value": LINE_STATE_ON}]})
+        await _wait_for(lambda: noon.get_entity("L5").line_state == LINE_STATE_ON)
+        polls = len(poller.intervals)
+        await _wait_for(lambda: len(poller.intervals) > polls)
+        assert poller.intervals[polls] == 0.01
+    finally:
+        await poller.stop()
+    assert not poller.running
+
+
+# The event rate is kept in per-second counts, so memory stays flat however many events arrive
+async def test_metrics_event_rate():
+    clock = [1000.0]
+    metrics = NoonMetrics()
+    with mock.patch("aiopynoon.metrics.time.monotonic", lambda: clock[0]):
+        for index in range(50000):
+            clock[0] = 1000 + index / 10000
+            metrics.record_event(0)
+        assert len(metrics._event_counts) <= RATE_WINDOW + 1
+        assert metrics.events == 50000
+        assert metrics.events_per_second == 50000 / RATE_WINDOW
+
+        clock[0] = 1000 + RATE_WINDOW + 2.5
+        assert metrics.events_per_second == 20000 / RATE_WINDOW
+        clock[0] = 1000 + RATE_WINDOW + 10
+        assert metrics.events_per_second == 0
+
+
+# A change to any line in a multiway group is copied to the others, with history for each
+async def test_multiway_propagation(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    history = await noon.enable_history()
+    master, slave = noon.get_entity("L1"), noon.get_entity("L2")
+    slave_events = mock.AsyncMock()
+    slave.subscribe(slave_events, None)
+
+    await _line_change(noon, "L1", LINE_STATE_OFF)
+    assert slave.line_state == LINE_STATE_OFF
+    assert [value for _, _, value in history.range("L2")] == [LINE_STATE_OFF]
+    assert slave_events.call_args.args[2] == NoonLine.Event.LINE_STATE_CHANGED
+
+    await noon._handle_change({"guid": "L2", "fields": [{"name": "dimmingLevel", "value": 30}]})
+    assert master.dimming_level == 30
+    assert [value for _, _, value in history.range("L1", field="dimmingLevel")] == [30]
+
+    command = await slave.set_brightness(60)
+    assert command.target == "L1"
+
+
+# With collapsed events, a group change is reported once, by the master
+async def test_multiway_collapsed_events(recording):
+    noon = await _started(recording, collapse_multiway_events=True)
+    await noon.close_eventstream()
+    master_events, slave_events = mock.AsyncMock(), mock.AsyncMock()
+    noon.get_entity("L1").subscribe(master_events, None)
+    noon.get_entity("L2").subscribe(slave_events, None)
+
+    await _line_change(noon, "L2", LINE_STATE_OFF)
+    assert master_events.call_count == 1
+    assert master_events.call_args.args[3] == {ATTR_LINE_STATE: LINE_STATE_OFF}
+    assert not slave_events.called
+    assert noon.get_entity("L2").line_state == LINE_STATE_OFF
+
+
+# The line table is updated in place, so views taken earlier see new events without copying
+async def test_line_table_views(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    table = noon.line_table
+    assert len(table) == 5
+    row = table.row("L4")
+    buffers = table.buffers()
+    assert buffers["lineOn"][row] == 0 and buffers["dimmingLevel"][row] == 30
+    assert buffers["lineOn"].readonly
+
+    await _line_change(noon, "L4", LINE_STATE_ON)
+    await noon._handle_change({"guid": "L4", "fields": [{"name": "dimmingLevel", "value": 45}]})
+    assert buffers["lineOn"][row] == 1 and buffers["dimmingLevel"][row] == 45
+    assert table.space_guids[table.space_index[row]] == "S2"
+
+
+async def test_line_table_numpy(recording):
+    pytest.importorskip("numpy")
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    table = noon.line_table
+    columns = table.as_numpy()
+    row = table.row("L5")
+    await _line_change(noon, "L5", LINE_STATE_ON)
+    assert columns["lineOn"][row] == 1
+    assert columns["lineOn"].base is not None
+    assert table.percent_on_by_space() == {"S1": 100.0, "S2": 50.0}
+
+
+# Without NumPy the percentages are the same, and as_numpy() explains what is missing
+async def test_line_table_without_numpy(recording, monkeypatch):
+    monkeypatch.setattr("aiopynoon.snapshot.numpy", None)
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    await _line_change(noon, "L5", LINE_STATE_ON)
+    await _line_change(noon, "L3", LINE_STATE_OFF)
+    assert noon.line_table.percent_on_by_space() == pytest.approx({"S1": 200 / 3, "S2": 50.0})
+    with pytest.raises(ImportError):
+        noon.line_table.as_numpy()
+
+
+# NoonSync runs a Noon on its own loop thread, and closes that loop when done
+async def test_sync(recording):
+    sync = NoonSync(noon_factory=lambda: NoonReplay(recording), start_timeout=10)
+    try:
+        events = sync.event_queue()
+        assert sync.snapshot(5)["lines"]["L4"]["lineState"] == LINE_STATE_OFF
+
+        command = sync.set_brightness("L4", 70, timeout=5)
+        assert sync.wait_applied(command, 5)
+        assert sync.snapshot(5)["lines"]["L4"] == {"name": "Ceiling", "space": "S2", "lineState": LINE_STATE_ON,
+            "dimmingLevel": 70}
+        assert events.get(timeout=5) == ("L4", NoonLine.Event.LINE_STATE_CHANGED, {ATTR_LINE_STATE: LINE_STATE_ON})
+
+        with pytest.raises(NoonInvalidParametersError):
+            sync.turn_on("GONE", timeout=5)
+    finally:
+        sync.close()
+    assert sync.loop.is_closed()
+    sync.close()
+
+
+# Zone aggregates follow member changes, and events only fire when an aggregate changes
+async def test_zone_aggregates(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    zone = await noon.add_zone("Hall", spaces=["S2"])
+    assert (zone.any_on, zone.all_off, zone.average_dimming_level) == (False, True, None)
+    callback = mock.AsyncMock()
+    zone.subscribe(callback, None)
+
+    await noon._handle_change({"guid": "L4", "fields": [{"name": "dimmingLevel", "value": 40}]})
+    assert not callback.called
+
+    await _line_change(noon, "L4", LINE_STATE_ON)
+    assert [call.args[2:] for call in callback.call_args_list] == [
+        (NoonZone.Event.ANY_ON_CHANGED, {"anyOn": True}),
+        (NoonZone.Event.ALL_OFF_CHANGED, {"allOff": False}),
+        (NoonZone.Event.AVERAGE_DIM_LEVEL_CHANGED, {"averageDimmingLevel": 40})]
+
+    callback.reset_mock()
+    await _line_change(noon, "L5", LINE_STATE_ON)
+    assert [call.args[2:] for call in callback.call_args_list] == [
+        (NoonZone.Event.AVERAGE_DIM_LEVEL_CHANGED, {"averageDimmingLevel": 50})]
+    assert zone.lines_on == 2
+
+    noon.remove_zone(zone)
+    assert noon.get_entity(zone.guid) is None
+
+
+# Each multiway group counts once, through its master
+async def test_zone_multiway(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    zone = await noon.add_zone("Kitchen", lines=["L1", "L2", "L3"])
+    assert sorted(line.guid for line in zone.lines) == ["L1", "L3"]
+    assert zone.lines_on == 2 and zone.average_dimming_level == 65
+    assert zone.line_ids == ["L1", "L2", "L3"]
+
+    await _line_change(noon, "L2", LINE_STATE_OFF)
+    assert zone.lines_on == 1 and zone.average_dimming_level == 50
+
+
+# Rediscovery replaces every line, and zones follow the new ones
+async def test_zone_rebinds_after_discovery(recording):
+    noon = await _started(recording)
+    await noon.close_eventstream()
+    zone = await noon.add_zone("Hall", spaces=["S2"])
+    old_line = noon.get_entity("L4")
+
+    noon._replay_emit({"guid": "L4", "fields": [{"name": ATTR_LINE_STATE, "value": LINE_STATE_ON}]})
+    await noon._refreshDevices()
+    assert noon.get_entity("L4") is not old_line
+    assert zone.any_on and zone.lines_on == 1
+
+    await _line_change(noon, "L5", LINE_STATE_ON)
+    assert zone.lines_on == 2 and zone.average_dimming_level == 45